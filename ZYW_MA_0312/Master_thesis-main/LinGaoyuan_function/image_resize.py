@@ -3,6 +3,7 @@ from torch.utils.data import Dataset
 import sys
 import json
 import torchvision
+import torch.nn.functional as F
 
 
 def resize_img(image, resize_fun):
@@ -10,4 +11,12 @@ def resize_img(image, resize_fun):
         image = image[None, ...]
     if len(image.shape) == 3 and image.shape[2] == 3:
         image = image.permute(2,0,1)
-    return resize_fun(image)
\ No newline at end of file
+    return resize_fun(image)
+
+def resize_img_batched(images, target_H, target_W):
+    '''
+    resize a batch of images / maps with one call on their device, bilinear with antialias like torchvision.transforms.Resize
+    :param images: [N, C, H, W] float tensor
+    :return: [N, C, target_H, target_W]
+    '''
+    return F.interpolate(images, size=(target_H, target_W), mode="bilinear", align_corners=False, antialias=True)
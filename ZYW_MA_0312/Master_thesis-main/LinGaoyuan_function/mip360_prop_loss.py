@@ -1,4 +1,5 @@
 import numpy as np
+import torch
 
 def inner_outer(t0, t1, y1):
   """Construct inner and outer measures on (t1, y1) for t0."""
@@ -68,3 +69,50 @@ def searchsorted(a, v):
     idx_lo = np.max(np.where(v_ge_a, i[..., :, None], i[..., :1, None]), -2)
     idx_hi = np.min(np.where(~v_ge_a, i[..., :, None], i[..., -1:, None]), -2)
     return idx_lo, idx_hi
+
+
+'''
+torch versions of the functions above, they run on the gpu and are used for the proposal loss of the proposal sampling
+in render_rays(). all inputs are batched along the first dimensions, the last dimension is the samples of a ray
+'''
+
+
+def searchsorted_torch(a, v):
+    """
+    same output as searchsorted(), computed with torch.searchsorted instead of a [..., len(a), len(v)] comparison
+    :param a: sorted reference points, tensor of shape [..., N]
+    :param v: query points, tensor of shape [..., M], sorted along the last dimension
+    :return: (idx_lo, idx_hi), where a[idx_lo] <= v < a[idx_hi]
+    """
+    'number of elements of a that are <= v'
+    idx = torch.searchsorted(a.contiguous(), v.contiguous(), right=True)
+    idx_lo = torch.clamp(idx - 1, min=0)
+    idx_hi = torch.clamp(idx, max=a.shape[-1] - 1)
+    return idx_lo, idx_hi
+
+
+def inner_outer_torch(t0, t1, y1):
+    """Construct inner and outer measures on (t1, y1) for t0."""
+    cy1 = torch.cat([torch.zeros_like(y1[..., :1]), torch.cumsum(y1, dim=-1)], dim=-1)
+    idx_lo, idx_hi = searchsorted_torch(t1, t0)
+
+    cy1_lo = torch.gather(cy1, -1, idx_lo)
+    cy1_hi = torch.gather(cy1, -1, idx_hi)
+
+    y0_outer = cy1_hi[..., 1:] - cy1_lo[..., :-1]
+    y0_inner = torch.where(idx_hi[..., :-1] <= idx_lo[..., 1:], cy1_lo[..., 1:] - cy1_hi[..., :-1],
+                           torch.zeros_like(y0_outer))
+    return y0_inner, y0_outer
+
+
+def lossfun_outer_torch(t, w, t_env, w_env, eps=torch.finfo(torch.float32).eps):
+    """
+    the proposal weight should be an upper envelope on the nerf weight, formular 13 of the mip-NeRF 360 paper
+    :param t: interval edges of the nerf samples, [N_rays, N_samples + 1]
+    :param w: weights of the nerf samples, [N_rays, N_samples], should be detached
+    :param t_env: interval edges of the proposal samples, [N_rays, N_proposal_samples + 1]
+    :param w_env: weights of the proposal samples, [N_rays, N_proposal_samples]
+    :return: loss of every nerf sample, [N_rays, N_samples]
+    """
+    _, w_outer = inner_outer_torch(t, t_env, w_env)
+    return torch.clamp(w - w_outer, min=0) ** 2 / (w + eps)
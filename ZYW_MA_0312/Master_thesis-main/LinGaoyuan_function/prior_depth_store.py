@@ -0,0 +1,217 @@
+import os
+import hashlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import torch
+
+from model_and_model_component.data_loaders.prior_cache import load_depth_value
+
+
+def prior_depth_cache_key(depth_value_files, cache_extra=None):
+    '''
+    key of a consolidated prior depth cache: the list of depth value files with their mtime and size, plus everything
+    else that changes the content of the cache (output size, resize method, ...)
+    '''
+    key = hashlib.sha1()
+    for depth_value_file in depth_value_files:
+        stat = os.stat(depth_value_file)
+        key.update("{}|{}|{}\n".format(depth_value_file, stat.st_mtime_ns, stat.st_size).encode())
+    key.update(repr(cache_extra).encode())
+    return key.hexdigest()
+
+
+def _load_depth_value_float32(depth_value_file, use_binary_cache):
+    return np.asarray(load_depth_value(depth_value_file, use_binary_cache), dtype=np.float32)
+
+
+def load_prior_depth_values(
+        depth_value_files,
+        out_shape,
+        resize_fn=None,
+        use_binary_cache=False,
+        num_workers=8,
+        cache_file=None,
+        cache_extra=None,
+        device="cuda",
+):
+    """
+    load the prior depth value of all images into one tensor. The files are read in parallel, json files by a process
+    pool (json.load holds the GIL), memory-mapped .npy files by a thread pool. The result is written to cache_file and
+    read from there on the next launch as long as the files, their mtimes and cache_extra did not change.
+    :param depth_value_files: list of *_depth_value_pred.json files
+    :param out_shape: (H, W) of a prior depth map in the output tensor
+    :param resize_fn: optional function that resizes a [1, H, W] float tensor to [1, out_shape[0], out_shape[1]]
+    :param num_workers: number of loader workers, <= 1 loads the files serially
+    :param cache_file: path of the consolidated cache, None disables the cache
+    :param cache_extra: anything else the content depends on, part of the cache key
+    :return: prior depth values, [len(depth_value_files), H, W] float tensor on device
+    """
+    out_shape = tuple(int(s) for s in out_shape)
+    key = None
+    if cache_file is not None:
+        key = prior_depth_cache_key(depth_value_files, (out_shape, cache_extra))
+        if os.path.exists(cache_file):
+            try:
+                cache = torch.load(cache_file, map_location="cpu")
+            except Exception as e:
+                print("can not read prior depth cache {}: {}".format(cache_file, e))
+                cache = None
+            if cache is not None and cache.get("key") == key:
+                print("load prior depth values from cache {}".format(cache_file))
+                return cache["prior_depth_values"].to(device)
+
+    prior_depth_values = torch.zeros((len(depth_value_files),) + out_shape, device=device)
+
+    load_fn = partial(_load_depth_value_float32, use_binary_cache=use_binary_cache)
+    if num_workers <= 1 or len(depth_value_files) <= 1:
+        depth_values = map(load_fn, depth_value_files)
+        executor = None
+    else:
+        executor_class = ThreadPoolExecutor if use_binary_cache is True else ProcessPoolExecutor
+        executor = executor_class(max_workers=num_workers)
+        depth_values = executor.map(load_fn, depth_value_files)
+
+    try:
+        for idx, depth_value in enumerate(depth_values):
+            depth_value = torch.from_numpy(depth_value)[None, ...]
+            if resize_fn is not None:
+                depth_value = resize_fn(depth_value)
+            prior_depth_values[idx, ...] = depth_value
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if cache_file is not None:
+        '''
+        write to a temporary file of this process first (every DDP rank writes its own), so that neither an interrupted
+        run nor concurrent ranks leave a broken cache behind
+        '''
+        tmp_file = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(cache_file) or ".", prefix=os.path.basename(cache_file) + ".", suffix=".tmp",
+                delete=False,
+            ) as f:
+                tmp_file = f.name
+                torch.save({"key": key, "prior_depth_values": prior_depth_values.cpu()}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print("can not write prior depth cache {}: {}".format(cache_file, e))
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    return prior_depth_values
+
+
+class PriorDepthStore(object):
+    '''
+    prior depth values of all images of a dataset, [num_images, H, W].
+
+    The training loop only touches the image of the current ray batch, so the values do not have to live on the GPU:
+        backend "cuda":   dense tensor on the GPU, the behaviour of the plain train_prior_depth_values tensor
+        backend "pinned": page-locked host memory, copied to the GPU with non_blocking transfers
+        backend "mmap":   np.memmap file on disk, only the pages of the images that are read are loaded
+    With the host backends only the active image is paged to the GPU (see get_image()), updates are written to the page
+    and through to the host storage. half=True stores the values as float16, the page on the GPU is always float32.
+    '''
+
+    backends = ["cuda", "pinned", "mmap"]
+
+    def __init__(self, num_images, H, W, backend="cuda", half=False, mmap_file=None, device="cuda"):
+        if backend not in self.backends:
+            raise Exception("unknown prior depth store backend: {}".format(backend))
+        self.shape = (int(num_images), int(H), int(W))
+        self.backend = backend
+        self.device = torch.device(device)
+        self.dtype = torch.float16 if half is True else torch.float32
+
+        if backend == "cuda":
+            self.storage = torch.zeros(self.shape, dtype=self.dtype, device=self.device)
+        elif backend == "pinned":
+            self.storage = torch.zeros(self.shape, dtype=self.dtype).pin_memory()
+        else:
+            if mmap_file is None:
+                raise Exception("the mmap prior depth store needs a mmap_file")
+            np_dtype = np.float16 if half is True else np.float32
+            self.mmap = np.memmap(mmap_file, dtype=np_dtype, mode="w+", shape=self.shape)
+            self.storage = torch.from_numpy(self.mmap)
+
+        self.page_idx = None
+        self.page = None
+
+    @classmethod
+    def from_tensor(cls, prior_depth_values, **kwargs):
+        """
+        :param prior_depth_values: [num_images, H, W] tensor on any device, e.g. from load_prior_depth_values() or torch.load()
+        """
+        store = cls(*prior_depth_values.shape, **kwargs)
+        for idx in range(len(store)):
+            store.storage[idx] = prior_depth_values[idx].to(store.storage.device, store.dtype)
+        return store
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_image(self, idx):
+        """
+        :param idx: index of the image, int or one element tensor like ray_batch["idx"]
+        :return: prior depth of the image, float32 [H, W] on self.device. The tensor may be shared with the store, change it
+        through set_image() / scatter_update() only
+        """
+        idx = int(idx)
+        if self.backend == "cuda":
+            return self.storage[idx].float()
+        if self.page_idx != idx:
+            self.page = self.storage[idx].to(self.device, non_blocking=True).float()
+            self.page_idx = idx
+        return self.page
+
+    def set_image(self, idx, values):
+        """
+        :param values: prior depth of the image, H * W values on any device
+        """
+        idx = int(idx)
+        values = values.reshape(self.shape[1:])
+        self.storage[idx] = values.to(self.storage.device, self.dtype)
+        if self.page_idx == idx:
+            self.page.copy_(values)
+
+    def scatter_update(self, idx, selected_inds, values, blend=None):
+        """
+        write the values of a few pixels in place, instead of writing back the whole image
+        :param idx: index of the image, int or one element tensor like ray_batch["idx"]
+        :param selected_inds: flat pixel indices, [N] np.ndarray or tensor like ray_batch["selected_inds"]
+        :param values: new prior depth of the pixels, [N] or [N, 1]
+        :param blend: optional blend weight in [0, 1], float or [N] tensor: prior = prior + blend * (values - prior).
+        None overwrites the prior with the values
+        """
+        idx = int(idx)
+        if self.backend == "cuda":
+            target = self.storage[idx].view(-1)
+        else:
+            target = self.get_image(idx).view(-1)
+
+        inds = torch.as_tensor(selected_inds, dtype=torch.long).to(target.device).reshape(-1)
+        values = values.reshape(-1).to(target.device, torch.float32)
+        if blend is not None:
+            if torch.is_tensor(blend):
+                blend = blend.reshape(-1).to(target.device, torch.float32)
+            values = torch.lerp(target[inds].float(), values, blend)
+        target[inds] = values.to(target.dtype)
+
+        'the page of the host backends is written through to the host storage'
+        if self.backend != "cuda":
+            self.storage[idx].view(-1)[inds.cpu()] = values.cpu().to(self.dtype)
+
+    def to_tensor(self):
+        'float32 copy of all values on the cpu, this is what save() writes'
+        return self.storage.float().cpu()
+
+    def save(self, path):
+        'same format as torch.save(train_prior_depth_values), the file can be read with torch.load() as a plain tensor'
+        if self.backend == "mmap":
+            self.mmap.flush()
+        torch.save(self.to_tensor(), path)
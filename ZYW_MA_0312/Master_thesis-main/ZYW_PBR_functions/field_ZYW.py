@@ -8,6 +8,7 @@ import mcubes
 from utils.base_utils import az_el_to_points, sample_sphere
 from utils.raw_utils import linear_to_srgb
 from utils.ref_utils import generate_ide_fn
+from ZYW_model.sample_pdf_ZYW import sample_pdf
 
 # Positional encoding embedding. Code was taken from https://github.com/bmild/nerf.
 class Embedder:
@@ -150,39 +151,6 @@ def get_sphere_intersection(pts, dirs):
     return dist
 
 # this function is borrowed from NeuS
-def sample_pdf(bins, weights, n_samples, det=False):
-    # This implementation is from NeRF
-    # Get pdf
-    weights = weights + 1e-5  # prevent nans
-    pdf = weights / torch.sum(weights, -1, keepdim=True)
-    cdf = torch.cumsum(pdf, -1)
-    cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], -1)
-    # Take uniform samples
-    if det:
-        u = torch.linspace(0. + 0.5 / n_samples, 1. - 0.5 / n_samples, steps=n_samples)
-        u = u.expand(list(cdf.shape[:-1]) + [n_samples])
-    else:
-        u = torch.rand(list(cdf.shape[:-1]) + [n_samples])
-
-    # Invert CDF
-    u = u.contiguous()
-    inds = torch.searchsorted(cdf, u, right=True)
-    below = torch.max(torch.zeros_like(inds - 1), inds - 1)
-    above = torch.min((cdf.shape[-1] - 1) * torch.ones_like(inds), inds)
-    inds_g = torch.stack([below, above], -1)  # (batch, N_samples, 2)
-
-    matched_shape = [inds_g.shape[0], inds_g.shape[1], cdf.shape[-1]]
-    cdf_g = torch.gather(cdf.unsqueeze(1).expand(matched_shape), 2, inds_g)
-    bins_g = torch.gather(bins.unsqueeze(1).expand(matched_shape), 2, inds_g)
-
-    denom = (cdf_g[..., 1] - cdf_g[..., 0])
-    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
-    t = (u - cdf_g[..., 0]) / denom
-    samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
-
-    return samples
-
-
 def get_weights(sdf_fun, inv_fun, z_vals, origins, dirs):
     points = z_vals.unsqueeze(-1) * dirs.unsqueeze(-2) + origins.unsqueeze(-2) # pn,sn,3
     inv_s = inv_fun(points[:, :-1, :])[..., 0]  # pn,sn-1
@@ -228,7 +196,7 @@ def get_intersection(sdf_fun, inv_fun, pts, dirs, sn0=128, sn1=9):
             z_vals = torch.linspace(0, 1, sn0) # sn0
             z_vals = max_dist * z_vals.unsqueeze(0) # pn,sn0
             weights, mid_sdf = get_weights(sdf_fun, inv_fun, z_vals, pts, dirs) # pn,sn0-1
-            z_vals_new = sample_pdf(z_vals, weights, sn1, True) # pn,sn1
+            z_vals_new = sample_pdf(z_vals, weights, sn1, True, det_midpoints=True) # pn,sn1
             weights, mid_sdf = get_weights(sdf_fun, inv_fun, z_vals_new, pts, dirs) # pn,sn1-1
             z_vals_mid = (z_vals_new[:,1:] + z_vals_new[:,:-1]) * 0.5
 
@@ -198,8 +198,21 @@ class ZYW_ReTR_model(nn.Module):
     'LinGaoyuan_20240930: retr model + model_and_model_component feature extractor or retr model + retr feature extractor'
     def forward(self, point3D, ray_batch, source_imgs_feat, z_vals, mask, ray_d, ray_diff, fea_volume=None, ret_alpha=True):
 
-        B, n_views, H, W, rgb_channel = ray_batch['src_rgbs'].shape  # LinGaoyuan_20240916: B = Batch NV = num_source_views
-        N_rand, N_samples, _ = point3D.shape
+        radiance = self.aggregate_views(source_imgs_feat, mask, ray_diff)  # (N_rand N_samples 35)
+
+        return self.forward_from_radiance(radiance, z_vals, ret_alpha=ret_alpha)
+
+    def aggregate_views(self, source_imgs_feat, mask, ray_diff):
+        """
+        view stage of forward(): view transformer and softmax weighting of the source views. every sample is independent
+        of the other samples of its ray, so the samples can also be processed in chunks, see the streaming projection of
+        render_rays()
+        :param source_imgs_feat: (N_rand, N_samples, n_views, 35)
+        :param mask: (N_rand, N_samples, n_views, 1)
+        :param ray_diff: (N_rand, N_samples, n_views, 4)
+        :return: radiance, (N_rand, N_samples, 35)
+        """
+        N_rand, N_samples = source_imgs_feat.shape[:2]
 
         img_rgb_sampled = source_imgs_feat[:, :, :, :3]  # LinGaoyuan_20240917: (N_rand, N_samples, n_views, 3)
         img_feat_sampled = source_imgs_feat[:,:,:,3:]  # LinGaoyuan_20240917: (N_rand, N_samples, n_views, 32)
@@ -230,6 +243,16 @@ class ZYW_ReTR_model(nn.Module):
         radiance = (source_imgs_feat * rearrange(weight,"N_rand N_samples n_views 1 -> n_views 1 N_rand N_samples", N_rand=N_rand, N_samples = N_samples)).sum(axis=0)
         radiance = rearrange(radiance, "DimRGB N_rand N_samples -> N_rand N_samples DimRGB")#(N_rand N_samples 35)
 
+        return radiance
+
+    def forward_from_radiance(self, radiance, z_vals, ret_alpha=True):
+        """
+        ray stage of forward(): occlusion transformer and ray transformer along the samples of every ray
+        :param radiance: (N_rand, N_samples, 35), output of aggregate_views()
+        :param z_vals: (N_rand, N_samples)
+        """
+        N_samples = radiance.shape[1]
+
         attn_mask = self.get_attn_mask(N_samples).type_as(radiance)
         input_occ = torch.cat((self.fuse_layer(radiance), self.order_posenc(100 * z_vals.reshape(-1,z_vals.shape[-1])).type_as(radiance)), dim=-1)#(N_rand N_samples 34)
         radiance_tokens = self.RadianceToken(input_occ).unsqueeze(1)
@@ -1,11 +1,23 @@
 import torch.nn as nn
-from utils import img2mse
+from utils import img2mse, TINY_NUMBER
 import torch
 
 from ZYW_PBR_functions.field_ZYW import AppShadingNetwork
 from ZYW_PBR_functions.PBR_MI_ZYW import NeILFPBR
 
 
+def weighted_mean(per_ray_loss, sample_weights, mask=None):
+    """
+    importance weighted mean of a per-ray loss, unbiased for sample weights 1 / (H * W * p(pixel))
+    :param per_ray_loss: [N_rand]
+    :param sample_weights: [N_rand]
+    :param mask: optional, [N_rand]
+    """
+    if mask is None:
+        return torch.mean(sample_weights * per_ray_loss)
+    return torch.sum(sample_weights * per_ray_loss * mask) / (torch.sum(mask) + TINY_NUMBER)
+
+
 class Criterion(nn.Module):
     default_cfg = {
         # shader network for NeRO method
@@ -31,10 +43,20 @@ class Criterion(nn.Module):
             pred_mask = None
         gt_rgb = ray_batch["rgb"]# Zhenyi Wan [2025/4/10] The ground truth RGB
 
-        loss = img2mse(pred_rgb, gt_rgb, pred_mask)
+        'the rays of the importance sample mode are weighted by their sample weights, see PixelErrorMap'
+        if ray_batch.get("sample_weights") is not None:
+            loss = weighted_mean(self.per_ray_mse(outputs, ray_batch), ray_batch["sample_weights"], pred_mask)
+        else:
+            loss = img2mse(pred_rgb, gt_rgb, pred_mask)
 
         return loss, scalars_to_log
 
+    def per_ray_mse(self, outputs, ray_batch):
+        """
+        :return: mse of the rgb of every ray, [N_rand]
+        """
+        return torch.mean((outputs["rgb"] - ray_batch["rgb"]) ** 2, dim=-1)
+
     def NeRO_loss(self, outputs, roughness_outputs, metallic_outputs, albedo_outputs, normals_outputs, ray_batch, scalars_to_log):
         """
         BRDF criterion
@@ -119,7 +141,18 @@ class Criterion(nn.Module):
 
         'LinGaoyuan_operation_20240906: add zhengzhisheng depth loss'
 
-        loss_depth = torch.mean((pred_depth_value - gt_depth_value) * (pred_depth_value - gt_depth_value))
+        'the sky-only rays of the sky_stratified sample mode have no depth prediction, see pad_nerf_rays()'
+        if "mask" in outputs:
+            sample_weights = ray_batch.get("sample_weights")
+            if sample_weights is None:
+                sample_weights = torch.ones_like(outputs["mask"])
+            loss_depth = weighted_mean(
+                ((pred_depth_value - gt_depth_value) ** 2)[..., 0], sample_weights, outputs["mask"].float()
+            )
+        elif ray_batch.get("sample_weights") is not None:
+            loss_depth = weighted_mean(((pred_depth_value - gt_depth_value) ** 2)[..., 0], ray_batch["sample_weights"])
+        else:
+            loss_depth = torch.mean((pred_depth_value - gt_depth_value) * (pred_depth_value - gt_depth_value))
         # N_rand = len(gt_depth_value)
         # loss_depth = (1/N_rand)*(torch.sum((pred_depth_value - gt_depth_value) * (pred_depth_value - gt_depth_value)))
 
@@ -4,6 +4,8 @@ from model_and_model_component.GNT_model_LinGaoyuan import GNT
 from model_and_model_component.GNT_feature_extractor import ResUNet
 
 from ZYW_model.ReTR_model_ZYW import ZYW_ReTR_model
+from ZYW_model.proposal_network_ZYW import ProposalNetwork
+from ZYW_model.occupancy_grid_ZYW import OccupancyGrid
 from LinGaoyuan_function.ReTR_function.ReTR_feature_extractor import FPN_FeatureExtractor
 from LinGaoyuan_function.ReTR_function.ReTR_feature_volume import FeatureVolume
 
@@ -71,6 +73,24 @@ class Model(object):
         if self.args.use_volume_feature is True and self.args.use_retr_feature_extractor is True:
             self.retr_feature_volume = FeatureVolume(volume_reso=100).to(device)
 
+        'the proposal mlp of the proposal sampling in render_rays(), see args.use_proposal_sampling'
+        if self.args.use_proposal_sampling is True:
+            self.proposal_net = ProposalNetwork().to(device)
+
+        '''
+        the occupancy grid of render_rays(), see args.use_occupancy_grid. it is saved and restored with the checkpoints,
+        occupancy_grid_restored tells the training whether it still has to be seeded from the depth priors
+        '''
+        if self.args.use_occupancy_grid is True:
+            self.occupancy_grid = OccupancyGrid(
+                args.contraction_type,
+                resolution=args.occupancy_grid_resolution,
+                threshold=args.occupancy_threshold,
+                decay=args.occupancy_decay,
+                device=device,
+            )
+        self.occupancy_grid_restored = False
+
         test_a = hasattr(self, 'retr_feature_volume')
 
 
@@ -85,6 +105,8 @@ class Model(object):
             learnable_params += list(self.retr_feature_volume.parameters())
         if hasattr(self, 'net_fine') and self.net_fine is not None:
             learnable_params += list(self.net_fine.parameters())
+        if hasattr(self, 'proposal_net'):
+            learnable_params += list(self.proposal_net.parameters())
 
         # learnable_params = list(self.net_coarse.parameters())
         # learnable_params += list(self.feature_net.parameters())
@@ -141,6 +163,9 @@ class Model(object):
                 lr=args.lrate_gnt,
             )
 
+        if hasattr(self, 'proposal_net'):
+            self.optimizer.add_param_group({"params": self.proposal_net.parameters(), "lr": args.lrate_proposal})
+
         self.scheduler = torch.optim.lr_scheduler.StepLR(
             self.optimizer, step_size=args.lrate_decay_steps, gamma=args.lrate_decay_factor
         )
@@ -181,6 +206,10 @@ class Model(object):
                 self.net_fine = torch.nn.parallel.DistributedDataParallel(
                     self.net_fine, device_ids=[args.local_rank], output_device=args.local_rank
                 )
+            if hasattr(self, 'proposal_net'):
+                self.proposal_net = torch.nn.parallel.DistributedDataParallel(
+                    self.proposal_net, device_ids=[args.local_rank], output_device=args.local_rank
+                )
 
     def switch_to_eval(self):
         self.net_coarse.eval()
@@ -196,6 +225,8 @@ class Model(object):
             self.retr_feature_volume.eval()
         if hasattr(self, 'net_fine') and self.net_fine is not None:
             self.net_fine.eval()
+        if hasattr(self, 'proposal_net'):
+            self.proposal_net.eval()
 
     def switch_to_train(self):
         self.net_coarse.train()
@@ -211,6 +242,8 @@ class Model(object):
             self.retr_feature_volume.train()
         if hasattr(self, 'net_fine') and self.net_fine is not None:
             self.net_fine.train()
+        if hasattr(self, 'proposal_net'):
+            self.proposal_net.train()
 
     def save_model(self, filename):
         ''
@@ -263,6 +296,11 @@ class Model(object):
                 "feature_net": de_parallel(self.feature_net).state_dict(),
             }
 
+        if hasattr(self, 'proposal_net'):
+            to_save["proposal_net"] = de_parallel(self.proposal_net).state_dict()
+        if hasattr(self, 'occupancy_grid'):
+            to_save["occupancy_grid"] = self.occupancy_grid.state_dict()
+
         torch.save(to_save, filename)
 
     def load_model(self, filename, load_opt=True, load_scheduler=True):
@@ -307,6 +345,11 @@ class Model(object):
         else:
             self.feature_net.load_state_dict(to_load["feature_net"])
 
+        if hasattr(self, 'proposal_net') and "proposal_net" in to_load.keys():
+            self.proposal_net.load_state_dict(to_load["proposal_net"])
+        if hasattr(self, 'occupancy_grid') and "occupancy_grid" in to_load.keys():
+            self.occupancy_grid.load_state_dict(to_load["occupancy_grid"])
+            self.occupancy_grid_restored = True
 
     def load_from_ckpt(
         self, out_folder, load_opt=True, load_scheduler=True, force_latest_ckpt=False
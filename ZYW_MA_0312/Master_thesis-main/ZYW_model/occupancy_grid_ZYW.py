@@ -0,0 +1,151 @@
+import torch
+import torch.distributed as dist
+
+
+'bounds of the contracted space of every contraction type of render_rays(), see LinGaoyuan_function/unbounded2bounded.py'
+contracted_space_bounds = {
+    'nerfstudio': (-2.0, 2.0),
+    'zhengzhisheng': (0.0, 1.0),
+    'xuyan': (0.0, 1.0),
+}
+
+
+class OccupancyGrid(object):
+    '''
+    binary occupancy grid over the bounded domain of the contracted space, used by render_rays() to drop the samples in
+    free space before projector.compute().
+
+    Every cell keeps an occupancy value. The cells around the depth priors are seeded with 1, see seed(). During training
+    the largest predicted weight of the samples in a cell is collected with accumulate() and every update() the value
+    of the observed cells becomes max(decay * value, weight). A cell is occupied while its value is above threshold.
+    Cells that are never observed keep their value, the ray transformer can not be evaluated at arbitrary points. The
+    free cells are only observed on the full-range steps of the training (args.occupancy_explore_interval), where
+    render_rays() keeps all samples. With DDP the observations of all ranks are combined in update(), so the grids of
+    the ranks stay identical.
+    '''
+
+    def __init__(self, contraction_type, resolution=128, threshold=0.01, decay=0.95, device="cuda"):
+        """
+        :param contraction_type: args.contraction_type, decides the bounds of the grid
+        :param resolution: number of cells along every axis
+        :param threshold: a cell is occupied if its value is larger than threshold
+        :param decay: decay of the value of an observed cell in update()
+        """
+        if contraction_type not in contracted_space_bounds:
+            raise Exception(
+                "the occupancy grid needs a contracted scene, contraction_type {} is not supported".format(contraction_type)
+            )
+        self.bound_min, self.bound_max = contracted_space_bounds[contraction_type]
+        self.resolution = resolution
+        self.threshold = threshold
+        self.decay = decay
+        self.device = device
+
+        num_cells = resolution ** 3
+        self.values = torch.zeros(num_cells, device=device)
+        self.observed_weights = torch.zeros(num_cells, device=device)
+        self.observed = torch.zeros(num_cells, dtype=torch.bool, device=device)
+        self.occupied = torch.zeros(num_cells, dtype=torch.bool, device=device)
+
+    def cell_index(self, pts):
+        """
+        :param pts: contracted points, [..., 3]
+        :return: flat index of the cell of every point, [...]
+        """
+        R = self.resolution
+        x = (pts.to(self.device) - self.bound_min) / (self.bound_max - self.bound_min) * R
+        x = torch.clamp(x.long(), 0, R - 1)
+        return (x[..., 0] * R + x[..., 1]) * R + x[..., 2]
+
+    def query(self, pts):
+        """
+        :param pts: contracted points, [..., 3]
+        :return: True for the points in occupied cells, [...]
+        """
+        return self.occupied[self.cell_index(pts)]
+
+    def seed(self, pts):
+        'mark the cells of the contracted points pts [..., 3], e.g. points around the depth priors, as occupied'
+        idx = self.cell_index(pts).reshape(-1)
+        self.values[idx] = 1.0
+        self.occupied[idx] = True
+
+    def accumulate(self, pts, weights):
+        """
+        collect the predicted weights of the samples of a training step, applied with the next update()
+        :param pts: contracted points of the samples, [N_rays, N_samples, 3]
+        :param weights: predicted weights of the samples, [N_rays, N_samples]
+        """
+        idx = self.cell_index(pts.detach()).reshape(-1)
+        self.observed_weights.scatter_reduce_(0, idx, weights.detach().reshape(-1).float(), reduce="amax")
+        self.observed[idx] = True
+
+    def update(self):
+        'called at the same steps by all ranks'
+        if dist.is_available() and dist.is_initialized():
+            observed = self.observed.to(torch.uint8)
+            dist.all_reduce(self.observed_weights, op=dist.ReduceOp.MAX)
+            dist.all_reduce(observed, op=dist.ReduceOp.MAX)
+            self.observed = observed.bool()
+        observed = self.observed
+        self.values[observed] = torch.maximum(self.values[observed] * self.decay, self.observed_weights[observed])
+        self.occupied = self.values > self.threshold
+        self.observed_weights.zero_()
+        self.observed.zero_()
+
+    def occupancy_ratio(self):
+        return self.occupied.float().mean().item()
+
+    def state_dict(self):
+        return {"values": self.values}
+
+    def load_state_dict(self, state_dict):
+        if state_dict["values"].numel() != self.values.numel():
+            raise Exception(
+                "the saved occupancy grid has {} cells, expected resolution {}".format(
+                    state_dict["values"].numel(), self.resolution
+                )
+            )
+        self.values = state_dict["values"].to(self.device)
+        self.occupied = self.values > self.threshold
+
+
+def seed_occupancy_grid_from_depth_priors(
+    occupancy_grid, contract_fn, poses, intrinsics, prior_depth_store, image_H, image_W, depth_range, margin=0.1,
+    stride=4, N_samples=4,
+):
+    """
+    seed the occupancy grid with points around the depth priors of the training images
+    :param contract_fn: contraction of render_rays(), maps scene points [..., 3] to the contracted space
+    :param poses: camera to world matrices of the images, [N_images, 4, 4]
+    :param intrinsics: 4 by 4 intrinsic matrices of the images at image_H x image_W, [N_images, 4, 4]
+    :param prior_depth_store: PriorDepthStore with the depth priors of the images
+    :param depth_range: (near_depth, far_depth), priors outside of it are not used, e.g. the sky
+    :param margin: the points are spread over [depth * (1 - margin), depth * (1 + margin)]
+    :param stride: only every stride-th pixel along both axes is used
+    :param N_samples: number of points per pixel
+    """
+    device = occupancy_grid.device
+    near_depth, far_depth = depth_range
+    steps = torch.linspace(1.0 - margin, 1.0 + margin, N_samples, device=device)
+    for i in range(len(prior_depth_store)):
+        depth = prior_depth_store.get_image(i).to(device)[::stride, ::stride].float()
+        H, W = prior_depth_store.shape[1], prior_depth_store.shape[2]
+
+        K = torch.as_tensor(intrinsics[i], dtype=torch.float32)[:3, :3].clone()
+        K[0] = K[0] * W / image_W
+        K[1] = K[1] * H / image_H
+        c2w = torch.as_tensor(poses[i], dtype=torch.float32, device=device)
+
+        v, u = torch.meshgrid(
+            torch.arange(0, H, stride, device=device).float(), torch.arange(0, W, stride, device=device).float(),
+            indexing="ij",
+        )
+        pixels = torch.stack((u.reshape(-1), v.reshape(-1), torch.ones_like(u.reshape(-1))), dim=0)  # (3, N)
+        rays_d = (c2w[:3, :3].mm(torch.inverse(K).to(device).mm(pixels))).t()  # (N, 3)
+
+        depth = depth.reshape(-1)
+        valid = torch.isfinite(depth) & (depth > near_depth) & (depth < far_depth)
+        z_vals = depth[valid][:, None] * steps[None, :]  # (N_valid, N_samples)
+        pts = c2w[None, None, :3, 3] + rays_d[valid][:, None, :] * z_vals[..., None]
+        occupancy_grid.seed(contract_fn(pts))
@@ -0,0 +1,43 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model_and_model_component.GNT_model_LinGaoyuan import Embedder
+
+
+class ProposalNetwork(nn.Module):
+    '''
+    tiny density mlp of the proposal sampling, see render_rays(). it only maps a (contracted) 3D point to a density, no
+    image features are projected, so it can be evaluated on many samples per ray. the density is only used to place
+    the samples of the projector and the ray transformer and is trained with the proposal loss of mip-NeRF 360
+    '''
+
+    def __init__(self, num_freqs=6, hidden_dim=64, num_layers=2):
+        """
+        :param num_freqs: number of frequencies of the positional encoding of the points
+        :param hidden_dim: width of the hidden layers
+        :param num_layers: number of hidden layers
+        """
+        super(ProposalNetwork, self).__init__()
+        self.pos_enc = Embedder(
+            input_dims=3,
+            include_input=True,
+            max_freq_log2=num_freqs - 1,
+            num_freqs=num_freqs,
+            log_sampling=True,
+            periodic_fns=[torch.sin, torch.cos],
+        )
+        layers = []
+        in_dim = self.pos_enc.out_dim
+        for _ in range(num_layers):
+            layers += [nn.Linear(in_dim, hidden_dim), nn.ReLU(inplace=True)]
+            in_dim = hidden_dim
+        layers.append(nn.Linear(in_dim, 1))
+        self.density_net = nn.Sequential(*layers)
+
+    def forward(self, pts):
+        """
+        :param pts: [N_rays, N_samples, 3]
+        :return: density, [N_rays, N_samples]
+        """
+        return F.softplus(self.density_net(self.pos_enc(pts))[..., 0])
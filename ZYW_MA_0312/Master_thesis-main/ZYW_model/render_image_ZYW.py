@@ -30,6 +30,7 @@ def render_single_image(
     use_updated_prior_depth=False,
     train_depth_prior=None,
     data_mode=None,
+    occupancy_grid=None,
 ):
     """
     :param ray_sampler: RaySamplingSingleImage for this view
@@ -62,7 +63,7 @@ def render_single_image(
     for i in range(0, N_rays, chunk_size):# Zhenyi Wan [2025/4/1] chunk_size works as stride
         chunk = OrderedDict()
         for k in ray_batch:
-            if k in ["camera", "depth_range", "src_rgbs", "src_cameras"]:
+            if k in ["camera", "depth_range", "src_rgbs", "src_cameras", "src_depth_values"]:
                 chunk[k] = ray_batch[k]
             elif ray_batch[k] is not None:
                 chunk[k] = ray_batch[k][i : i + chunk_size]
@@ -99,6 +100,7 @@ def render_single_image(
             use_updated_prior_depth=use_updated_prior_depth,
             train_depth_prior=train_depth_prior_chunk,
             data_mode = data_mode,
+            occupancy_grid=occupancy_grid,
         )
 
         # handle both coarse and fine outputs
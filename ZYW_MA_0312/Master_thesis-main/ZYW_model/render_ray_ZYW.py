@@ -1,8 +1,10 @@
 import torch
+from torch.utils.checkpoint import checkpoint
 from collections import OrderedDict
 from LinGaoyuan_function.unbounded2bounded import (SceneContraction, contract_to_unisphere_LinGaoyuan,
                                                    contract_to_unisphere_LinGaoyuan_xuyan)
 from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_model
+from ZYW_model.sample_pdf_ZYW import sample_pdf
 # import imaginaire.model_utils.gancraft.voxlib as voxlib
 
 ########################################################################################################################
@@ -10,62 +12,14 @@ from model_and_model_component.ReTR_model_LinGaoyuan import LinGaoyuan_ReTR_mode
 ########################################################################################################################
 
 
-def sample_pdf(bins, weights, N_samples, det=False):
-    """
-    :param bins: tensor of shape [N_rays, M+1], M is the number of bins
-    :param weights: tensor of shape [N_rays, M]
-    :param N_samples: number of samples along each ray
-    :param det: if True, will perform deterministic sampling
-    :return: [N_rays, N_samples]
-    """
-
-    M = weights.shape[1]
-    weights += 1e-5
-    # Get pdf
-    pdf = weights / torch.sum(weights, dim=-1, keepdim=True)  # [N_rays, M]
-    cdf = torch.cumsum(pdf, dim=-1)  # [N_rays, M]
-    cdf = torch.cat([torch.zeros_like(cdf[:, 0:1]), cdf], dim=-1)  # [N_rays, M+1]
-
-    # Take uniform samples
-    if det:
-        u = torch.linspace(0.0, 1.0, N_samples, device=bins.device)
-        u = u.unsqueeze(0).repeat(bins.shape[0], 1)  # [N_rays, N_samples]
-    else:
-        u = torch.rand(bins.shape[0], N_samples, device=bins.device)
-
-    # Invert CDF
-    above_inds = torch.zeros_like(u, dtype=torch.long)  # [N_rays, N_samples]
-    for i in range(M):
-        above_inds += (u >= cdf[:, i : i + 1]).long()
-
-    # random sample inside each bin
-    below_inds = torch.clamp(above_inds - 1, min=0)
-    inds_g = torch.stack((below_inds, above_inds), dim=2)  # [N_rays, N_samples, 2]
-
-    cdf = cdf.unsqueeze(1).repeat(1, N_samples, 1)  # [N_rays, N_samples, M+1]
-    cdf_g = torch.gather(input=cdf, dim=-1, index=inds_g)  # [N_rays, N_samples, 2]
-
-    bins = bins.unsqueeze(1).repeat(1, N_samples, 1)  # [N_rays, N_samples, M+1]
-    bins_g = torch.gather(input=bins, dim=-1, index=inds_g)  # [N_rays, N_samples, 2]
-
-    # t = (u-cdf_g[:, :, 0]) / (cdf_g[:, :, 1] - cdf_g[:, :, 0] + TINY_NUMBER)  # [N_rays, N_samples]
-    # fix numeric issue
-    denom = cdf_g[:, :, 1] - cdf_g[:, :, 0]  # [N_rays, N_samples]
-    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
-    t = (u - cdf_g[:, :, 0]) / denom
-
-    samples = bins_g[:, :, 0] + t * (bins_g[:, :, 1] - bins_g[:, :, 0])
-
-    return samples
-
-
-def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=False, det=False):
+def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=False, det=False, ray_bounds=None):
     """
     :param ray_o: origin of the ray in scene coordinate system; tensor of shape [N_rays, 3]
     :param ray_d: homogeneous ray direction vectors in scene coordinate system; tensor of shape [N_rays, 3]
     :param depth_range: [near_depth, far_depth]
     :param inv_uniform: if True, uniformly sampling inverse depth
     :param det: if True, will perform deterministic sampling
+    :param ray_bounds: optional per-ray [near_depth, far_depth], tensor of shape [N_rays, 2], replaces depth_range
     :return: tensor of shape [N_rays, N_samples, 3]
     """
     # will sample inside [near_depth, far_depth]
@@ -74,9 +28,13 @@ def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=Fa
     far_depth_value = depth_range[0, 1]
     assert near_depth_value > 0 and far_depth_value > 0 and far_depth_value > near_depth_value
 
-    near_depth = near_depth_value * torch.ones_like(ray_d[..., 0])# Zhenyi Wan [2025/4/8] [N_rays]
+    if ray_bounds is not None:
+        near_depth = ray_bounds[:, 0]  # [N_rays]
+        far_depth = ray_bounds[:, 1]  # [N_rays]
+    else:
+        near_depth = near_depth_value * torch.ones_like(ray_d[..., 0])# Zhenyi Wan [2025/4/8] [N_rays]
 
-    far_depth = far_depth_value * torch.ones_like(ray_d[..., 0])# Zhenyi Wan [2025/4/8] [N_rays]
+        far_depth = far_depth_value * torch.ones_like(ray_d[..., 0])# Zhenyi Wan [2025/4/8] [N_rays]
 
     # Zhenyi Wan [2025/4/8] Get the z_vals inverse or uniformly
     if inv_uniform:
@@ -109,44 +67,81 @@ def sample_along_camera_ray(ray_o, ray_d, depth_range, N_samples, inv_uniform=Fa
     return pts, z_vals
 
 
-def sample_prior_depth_perturb(ray_o, ray_d, depth_prior, depth_offset_ratio = 0.05, N_samples_d = 32, inv_uniform=False, det=False):
+def depth_prior_ray_bounds(depth_prior, sky_mask, depth_range, margin=0.3):
+    """
+    per-ray sampling bounds around the depth prior, [depth * (1 - margin), depth * (1 + margin)] clamped to depth_range.
+    sky rays and rays with an invalid prior (not finite or <= 0) fall back to the global depth_range
+    :param depth_prior: [N_rays, 1]
+    :param sky_mask: [N_rays, 1], sky area = 0, other area = 1
+    :param depth_range: [near_depth, far_depth]
+    :return: [N_rays, 2] near / far depth of every ray
+    """
+    near_depth_value = float(depth_range[0, 0])
+    far_depth_value = float(depth_range[0, 1])
+    depth_prior = depth_prior.reshape(-1).float()
+
+    near_depth = torch.clamp(depth_prior * (1 - margin), min=near_depth_value, max=far_depth_value)
+    far_depth = torch.clamp(depth_prior * (1 + margin), min=near_depth_value, max=far_depth_value)
+    valid = torch.isfinite(depth_prior) & (depth_prior > 0) & (sky_mask.reshape(-1) != 0) & (far_depth > near_depth)
+
+    near_depth = torch.where(valid, near_depth, torch.full_like(near_depth, near_depth_value))
+    far_depth = torch.where(valid, far_depth, torch.full_like(far_depth, far_depth_value))
+    return torch.stack((near_depth, far_depth), dim=-1)
+
+
+def sample_prior_depth_perturb(ray_o, ray_d, depth_prior, depth_offset_ratio = 0.05, N_samples_d = 32, inv_uniform=False, det=False,
+                               stratified=False):
     """
     :param ray_o: origin of the ray in scene coordinate system; tensor of shape [N_rays, 3]
    :param ray_d: homogeneous ray direction vectors in scene coordinate system; tensor of shape [N_rays, 3]
    :param depth_prior: [N_rays, 1]
    :param depth_offset_ratio: scale of depth perturbation, default is 0.05, indicates the offset of the depth value
    :param N_samples_d: numbers of points along a ray, default is 32
+   :param inv_uniform: only used with stratified, the samples are uniform in inverse depth between the bounds
+   :param det: only used with stratified, if False one sample is drawn uniformly inside every interval
+   :param stratified: if False, N_samples_d evenly spaced float32 depths between the bounds, bit-identical to the
+   torch.linspace of every ray of the original loop. if True, inv_uniform and det are honoured like in
+   sample_along_camera_ray(), see args.prior_depth_stratified
    :return: tensor of shape [N_rays, N_samples, 3]
     """
     mids = depth_prior # Zhenyi Wan [2025/4/8] [N_rays, 1]
     uppers = mids*(1+depth_offset_ratio)
     lowers = mids*(1-depth_offset_ratio)
 
-    batch_size = depth_prior.size(0)# Zhenyi Wan [2025/4/8] N_rays
-    z_vals = torch.zeros((batch_size, N_samples_d)).cuda()# Zhenyi Wan [2025/4/8] [N_rays, N_samples_d]
-
-    for i in range(batch_size):
-        upper = uppers[i, 0]
-        lower = lowers[i, 0]
-        z_vals[i] = torch.linspace(lower, upper, N_samples_d)
-
-
-    # z_vals = []
-    # for i in range(len(mids)):
-    #     upper = uppers[i,0]
-    #     lower = lowers[i,0]
-    #     z_val = torch.linspace(lower, upper, N_samples_d).unsqueeze(0)
-    #     if i==0:
-    #         z_vals = z_val
-    #     else:
-    #         z_vals = torch.cat((z_vals, z_val),dim=0)
+    if stratified is not True:
+        '''
+        all rays at once with the arithmetic of torch.linspace: start + step * i for the first half of the samples and
+        end - step * (N - 1 - i) for the second half, both as a fused multiply-add (addcmul)
+        '''
+        lowers, uppers = lowers.float(), uppers.float()
+        if N_samples_d == 1:
+            z_vals = lowers.clone()
+        else:
+            step = (uppers - lowers) / (N_samples_d - 1)
+            inds = torch.arange(N_samples_d, device=depth_prior.device, dtype=torch.float32)[None, :]
+            z_vals = torch.where(
+                inds < N_samples_d // 2,
+                torch.addcmul(lowers, step, inds),
+                torch.addcmul(uppers, step, (N_samples_d - 1) - inds, value=-1),
+            )# Zhenyi Wan [2025/4/8] [N_rays, N_samples_d]
+        pts = ray_o[..., None, :] + ray_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples, 3]
+        return pts, z_vals
+
+    'all rays at once: [N_rays, 1] bounds times [1, N_samples_d] steps'
+    steps = torch.linspace(0.0, 1.0, N_samples_d, device=depth_prior.device, dtype=depth_prior.dtype)[None, :]
+    if inv_uniform:
+        z_vals = 1.0 / (1.0 / lowers + steps * (1.0 / uppers - 1.0 / lowers))# Zhenyi Wan [2025/4/8] [N_rays, N_samples_d]
+    else:
+        z_vals = lowers + steps * (uppers - lowers)# Zhenyi Wan [2025/4/8] [N_rays, N_samples_d]
 
-    # ray_d = ray_d.unsqueeze(1).repeat(1, N_samples_d, 1)  # [N_rays, N_samples, 3]
-    # ray_o = ray_o.unsqueeze(1).repeat(1, N_samples_d, 1)
-    ray_d = ray_d[..., None,:].repeat(1, N_samples_d, 1)  # [N_rays, N_samples, 3]
-    ray_o = ray_o[..., None,:].repeat(1, N_samples_d, 1)
+    if not det:
+        # same stratified jitter as sample_along_camera_ray()
+        z_mids = 0.5 * (z_vals[:, 1:] + z_vals[:, :-1])
+        upper = torch.cat([z_mids, z_vals[:, -1:]], dim=-1)
+        lower = torch.cat([z_vals[:, 0:1], z_mids], dim=-1)
+        z_vals = lower + (upper - lower) * torch.rand_like(z_vals)
 
-    pts = ray_o + ray_d * z_vals[..., :, None]
+    pts = ray_o[..., None, :] + ray_d[..., None, :] * z_vals[..., :, None]  # [N_rays, N_samples, 3]
 
     return pts, z_vals
 
@@ -161,6 +156,115 @@ def sample_pts_with_z_vals(ray_o, ray_d, z_vals):
     return pts
 
 
+def contract_pts(pts, contraction_type):
+    'the unbounded function should be used for the pts after pts is generated from sample_along_camera_ray()'
+    if contraction_type == 'nerfstudio':
+        scene_contraction = SceneContraction(order=float("inf"))
+        pts = scene_contraction(pts)
+    elif contraction_type == 'zhengzhisheng':
+        pts = contract_to_unisphere_LinGaoyuan(pts)
+    elif contraction_type == 'xuyan':
+        pts = contract_to_unisphere_LinGaoyuan_xuyan(pts)
+    return pts
+
+
+def z_vals_to_intervals(z_vals):
+    """
+    interval edges of the samples of a ray, the midpoints between the samples plus the first and the last sample
+    :param z_vals: [N_rays, N_samples]
+    :return: [N_rays, N_samples + 1]
+    """
+    mids = 0.5 * (z_vals[:, 1:] + z_vals[:, :-1])
+    return torch.cat([z_vals[:, :1], mids, z_vals[:, -1:]], dim=-1)
+
+
+def sample_with_proposal_network(proposal_net, ray_o, ray_d, z_vals, N_samples, contraction_type, det=False):
+    """
+    proposal sampling of mip-NeRF 360: the tiny proposal mlp is evaluated on the dense samples z_vals, N_samples new
+    samples are drawn from its weights, only those are seen by the projector and the ray transformer
+    :param proposal_net: ProposalNetwork
+    :param z_vals: dense samples of every ray, [N_rays, N_proposal_samples]
+    :param N_samples: number of samples that are returned
+    :return: pts [N_rays, N_samples, 3], z_vals [N_rays, N_samples], interval edges [N_rays, N_proposal_samples + 1]
+    and weights [N_rays, N_proposal_samples] of the proposal samples for the proposal loss
+    """
+    pts_env = contract_pts(sample_pts_with_z_vals(ray_o, ray_d, z_vals), contraction_type)
+    sigma_env = proposal_net(pts_env)  # [N_rays, N_proposal_samples]
+
+    'same compositing as raw2outputs(), the ray transformer does not use the intervals either'
+    alpha_env = 1.0 - torch.exp(-sigma_env)
+    T_env = torch.cumprod(1.0 - alpha_env + 1e-10, dim=-1)[:, :-1]
+    T_env = torch.cat((torch.ones_like(T_env[:, 0:1]), T_env), dim=-1)
+    w_env = alpha_env * T_env
+
+    t_env = z_vals_to_intervals(z_vals)
+    'the samples do not carry gradients, the proposal mlp is only trained by the proposal loss'
+    z_samples = sample_pdf(bins=t_env, weights=w_env.detach(), N_samples=N_samples, det=det, det_midpoints=det)
+    z_samples, _ = torch.sort(z_samples.detach(), dim=-1)
+
+    pts = sample_pts_with_z_vals(ray_o, ray_d, z_samples)
+    return pts, z_samples, t_env, w_env
+
+
+def compact_occupied_samples(z_vals, occupied, min_samples=8, det=False):
+    """
+    drop the samples in free space: every ray keeps K samples, K is the largest number of occupied samples of a ray in
+    the batch (rounded up to a multiple of 8, at least min_samples). the K samples are drawn inside the occupied
+    intervals of the ray, rays without any occupied sample keep the whole range. the ray transformer needs the same number
+    of samples on every ray, so the rays with fewer occupied samples are sampled more densely instead of being padded
+    :param z_vals: [N_rays, N_samples]
+    :param occupied: [N_rays, N_samples], True for the samples in occupied cells of the occupancy grid
+    :return: [N_rays, K], K <= N_samples
+    """
+    'e.g. an image without nerf rays in sample_mode sky_stratified'
+    if z_vals.shape[0] == 0:
+        return z_vals
+
+    N_samples = z_vals.shape[-1]
+    K = int(occupied.sum(dim=-1).max())
+    K = min(max(-(-K // 8) * 8, min_samples), N_samples)
+    if K == N_samples:
+        return z_vals
+
+    weights = occupied.float()
+    weights[weights.sum(dim=-1) == 0] = 1.0
+    z_vals = sample_pdf(bins=z_vals_to_intervals(z_vals), weights=weights, N_samples=K, det=det, det_midpoints=det)
+    z_vals, _ = torch.sort(z_vals, dim=-1)
+    return z_vals
+
+
+def render_retr_streaming(net, projector, pts, z_vals, ray_batch, featmaps, chunk_samples, ret_alpha=False):
+    """
+    streaming projection for the ReTR model: the samples are projected in chunks of chunk_samples along the rays and every
+    chunk is reduced right away by the view stage of the model (net.aggregate_views), so the [N_rays, N_samples, n_views,
+    3+d] features, ray_diff and mask of all samples are never held at once. with gradients the chunks are checkpointed
+    and projected again in the backward pass
+    :param net: ZYW_ReTR_model
+    :param pts: [N_rays, N_samples, 3]
+    :return: output of net.forward()
+    """
+    def project_and_aggregate_views(pts_chunk):
+        rgb_feat, ray_diff, mask = projector.compute(
+            pts_chunk,
+            ray_batch["camera"],
+            ray_batch["src_rgbs"],
+            ray_batch["src_cameras"],
+            featmaps=featmaps,
+            src_depths=ray_batch["src_depth_values"],
+        )
+        return net.aggregate_views(rgb_feat, mask, ray_diff)
+
+    radiance = []
+    for i in range(0, pts.shape[1], chunk_samples):
+        pts_chunk = pts[:, i : i + chunk_samples]
+        if torch.is_grad_enabled():
+            radiance.append(checkpoint(project_and_aggregate_views, pts_chunk, use_reentrant=False))
+        else:
+            radiance.append(project_and_aggregate_views(pts_chunk))
+    radiance = torch.cat(radiance, dim=1)  # [N_rays, N_samples, 3+d]
+    return net.forward_from_radiance(radiance, z_vals, ret_alpha=ret_alpha)
+
+
 ########################################################################################################################
 # ray rendering of nerf
 ########################################################################################################################
@@ -250,6 +354,23 @@ def sample_fine_pts(inv_uniform, N_importance, det, N_samples, ray_batch, weight
     return pts, z_vals
 
 
+def pad_nerf_rays(outputs, num_nerf_rays, N_rays):
+    """
+    pad the per-ray outputs of the nerf rays with zeros for the sky-only rays of the sky_stratified sample mode and add
+    outputs["mask"], 1 for the nerf rays, 0 for the sky-only rays
+    """
+    if outputs is None:
+        return None
+    for k, v in outputs.items():
+        'rgb_sky is computed for all rays by the sky model'
+        if k == "rgb_sky" or not torch.is_tensor(v) or v.dim() == 0 or v.shape[0] != num_nerf_rays:
+            continue
+        outputs[k] = torch.cat((v, v.new_zeros((N_rays - num_nerf_rays,) + v.shape[1:])), dim=0)
+    if "rgb" in outputs:
+        outputs["mask"] = (torch.arange(N_rays, device=outputs["rgb"].device) < num_nerf_rays).float()
+    return outputs
+
+
 def render_rays(
     args,
     ray_batch,
@@ -271,6 +392,8 @@ def render_rays(
     train_depth_prior = None,
     feature_volume = None,
     data_mode = None,
+    occupancy_grid = None,
+    occupancy_full_range = False,
     # retr_model = None,
 ):
     """
@@ -282,6 +405,9 @@ def render_rays(
     :param det: if True, will deterministicly sample depths
     :param ret_alpha: if True, will return learned 'density' values inferred from the attention maps
     :param single_net: if True, will use single network, can be cued with both coarse and fine points
+    :param occupancy_grid: optional OccupancyGrid, the samples in free space are dropped before projector.compute()
+    :param occupancy_full_range: if True, the samples are not dropped but all of them are returned in
+    ret["outputs_occupancy"], so that the free cells of the grid are observed again
     :return: {'outputs_coarse': {}, 'outputs_fine': {}}
     """
 
@@ -290,34 +416,69 @@ def render_rays(
 
     sky_mask = ray_batch["sky_mask"]  # sky area = 0, other area = 1
 
+    '''
+    sky_stratified sample mode: the first num_nerf_rays rays are non-sky rays, the rest are sky-only rays that are only
+    rendered by the sky model. projector and transformer only run on the nerf rays, their outputs are padded with zeros
+    for the sky-only rays and outputs["mask"] marks the nerf rays, see pad_nerf_rays()
+    '''
+    N_rays_total = ray_o.shape[0]
+    num_nerf_rays = ray_batch.get("num_nerf_rays")
+    nerf_ray_batch = ray_batch
+    if num_nerf_rays is not None:
+        ray_o, ray_d = ray_o[:num_nerf_rays], ray_d[:num_nerf_rays]
+        nerf_ray_batch = dict(ray_batch, ray_o=ray_o, ray_d=ray_d)
+
     # pts: [N_rays, N_samples, 3]
     # z_vals: [N_rays, N_samples]
 
+    'LinGaoyuan_operation_20240920: add a new if condition: when data_mode is val use depth_value from ray_batch as depth_prior'
+    if use_updated_prior_depth is False or data_mode == 'val':
+        depth_prior = ray_batch["depth_value"]
+    elif mode == 'train':
+        depth_prior = train_depth_prior[ray_batch['selected_inds']]
+    else:
+        depth_prior = train_depth_prior
+    if num_nerf_rays is not None:
+        depth_prior = depth_prior[:num_nerf_rays]
+
+    'with args.depth_bounded_sampling the samples are spread between per-ray bounds around the depth prior'
+    if args.depth_bounded_sampling is True:
+        ray_bounds = depth_prior_ray_bounds(
+            depth_prior, sky_mask[:ray_o.shape[0]], ray_batch["depth_range"], margin=args.depth_bound_margin
+        )
+    else:
+        ray_bounds = None
+
+    '''
+    with args.use_proposal_sampling the rays are first sampled densely with args.N_proposal_samples, the proposal mlp
+    places the N_samples samples that are seen by the projector and the ray transformer, see sample_with_proposal_network()
+    '''
+    sample_with_prior_depth = args.sample_with_prior_depth is True and use_updated_prior_depth is True
+    use_proposal_sampling = args.use_proposal_sampling is True and not sample_with_prior_depth
 
     # Zhenyi Wan [2025/4/8] Part1: Get the randomly chosen z_vals and the corresponding pts
     pts, z_vals = sample_along_camera_ray(
         ray_o=ray_o,
         ray_d=ray_d,
         depth_range=ray_batch["depth_range"],
-        N_samples=N_samples,
+        N_samples=args.N_proposal_samples if use_proposal_sampling else N_samples,
         inv_uniform=inv_uniform,
         det=det,
+        ray_bounds=ray_bounds,
     )
 
-    'LinGaoyuan_operation_20240920: add a new if condition: when data_mode is val use depth_value from ray_batch as depth_prior'
-    if use_updated_prior_depth is False or data_mode == 'val':
-        depth_prior = ray_batch["depth_value"]
-    elif mode == 'train':
-        depth_prior = train_depth_prior[ray_batch['selected_inds']]
-    else:
-        depth_prior = train_depth_prior
+    if use_proposal_sampling:
+        pts, z_vals, t_env, w_env = sample_with_proposal_network(
+            model.proposal_net, ray_o, ray_d, z_vals, N_samples, args.contraction_type, det=det
+        )
 
     N_samples_d = args.N_samples_depth
 
     'LinGaoyuan_operation_20240907: the uniform sampling will be used before training epoch reach preset value, after that the prior depth guided sampling is used'
-    if args.sample_with_prior_depth is True and use_updated_prior_depth is True:
+    if sample_with_prior_depth:
         pts_with_prior_depth, z_vals_with_prior_depth = sample_prior_depth_perturb(ray_o, ray_d, depth_prior, depth_offset_ratio=0.2,
-                                             N_samples_d=N_samples_d, inv_uniform=inv_uniform, det=det)
+                                             N_samples_d=N_samples_d, inv_uniform=inv_uniform, det=det,
+                                             stratified=args.prior_depth_stratified)
 
         z_vals_total = torch.cat((z_vals, z_vals_with_prior_depth), dim=-1)# Zhenyi Wan [2025/4/8] [N_rays, N_samples+N_samples_d]
         z_vals_total, z_vals_total_indices = torch.sort(z_vals_total, dim=-1)
@@ -330,22 +491,44 @@ def render_rays(
         # z_vals = z_vals_total
 
 
+    'the occlusion test of the projector compares the depth of the projected points with the metric depth priors'
+    if args.occlusion_test is True and args.contraction_type is not None:
+        raise Exception("occlusion_test needs the uncontracted points, contraction_type has to be None")
+    'rectify_inplane_rotation rotates the source images and poses, but not their depth priors'
+    if args.occlusion_test is True and args.rectify_inplane_rotation is True:
+        raise Exception("occlusion_test can not be combined with rectify_inplane_rotation")
+
     # Zhenyi Wan [2025/4/8] Decide a contraction type for the points
-    'the unbounded function should be used for the pts after pts is generated from sample_along_camera_ray()'
-    contraction_type = args.contraction_type  # 'zhengzhisheng' of 'nerfstudio'
+    pts = contract_pts(pts, args.contraction_type)  # 'zhengzhisheng' of 'nerfstudio'
 
-    if contraction_type == 'nerfstudio':
-        scene_contraction = SceneContraction(order=float("inf"))
-        pts = scene_contraction(pts)
-    elif contraction_type == 'zhengzhisheng':
-        pts = contract_to_unisphere_LinGaoyuan(pts)
-    elif contraction_type == 'xuyan':
-        pts = contract_to_unisphere_LinGaoyuan_xuyan(pts)
+    if occupancy_grid is not None and occupancy_full_range is not True:
+        z_vals = compact_occupied_samples(
+            z_vals, occupancy_grid.query(pts), min_samples=args.occupancy_min_samples, det=det
+        )
+        pts = contract_pts(sample_pts_with_z_vals(ray_o, ray_d, z_vals), args.contraction_type)
 
     N_rays, N_samples = pts.shape[:2]
 
+    '''
+    with args.stream_projection the samples are projected in chunks along the rays and consumed by the view stage of the
+    ReTR model right away, see render_retr_streaming()
+    '''
+    if args.stream_projection is True:
+        if args.use_retr_model is not True or args.use_volume_feature is True or args.BRDF_model is True:
+            raise Exception("stream_projection is only supported for the ReTR model without feature volume and BRDF model")
+        rgb = render_retr_streaming(
+            model.net_coarse,
+            projector,
+            pts,
+            z_vals,
+            ray_batch,
+            featmaps if args.use_retr_feature_extractor is True else featmaps[0],
+            args.projection_chunk_samples,
+            ret_alpha=ret_alpha,
+        )
+        BRDF_Buffer = None
     # Zhenyi Wan [2025/4/8] Use the model,change the ReTR part. add additonal BRDF outputs
-    if args.use_retr_model is True:
+    elif args.use_retr_model is True:
         if args.use_retr_feature_extractor is True:
             if args.use_volume_feature is not True:
                 'LinGaoyuan_20240930: retr model + retr feature extractor'
@@ -355,6 +538,7 @@ def render_rays(
                     ray_batch["src_rgbs"],
                     ray_batch["src_cameras"],
                     featmaps=featmaps,
+                    src_depths=ray_batch["src_depth_values"],
                 )
                 rgb = model.net_coarse(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha)
                 if args.BRDF_model is True:
@@ -372,6 +556,7 @@ def render_rays(
                     ray_batch["src_rgbs"],
                     ray_batch["src_cameras"],
                     featmaps=featmaps,
+                    src_depths=ray_batch["src_depth_values"],
                 )
                 rgb = model.net_coarse.forward_retr(pts, ray_batch, rgb_feat, z_vals, mask, ray_d, ray_diff, ret_alpha=ret_alpha, fea_volume=feature_volume)
                 if args.BRDF_model is True:
@@ -388,6 +573,7 @@ def render_rays(
                 ray_batch["src_rgbs"],
                 ray_batch["src_cameras"],
                 featmaps=featmaps[0],
+                src_depths=ray_batch["src_depth_values"],
             )  # [N_rays, N_samples, N_views, x]
             # TODO: include pixel mask in ray transformer
             # pixel_mask = (
@@ -409,6 +595,7 @@ def render_rays(
             ray_batch["src_rgbs"],
             ray_batch["src_cameras"],
             featmaps=featmaps[0],
+            src_depths=ray_batch["src_depth_values"],
         )
         rgb = model.net_coarse(rgb_feat, ray_diff, mask, pts, ray_d)
 
@@ -431,6 +618,8 @@ def render_rays(
         'LinGaoyuan_operation_20240906: add cov of depth prediction based on Uncle SLAM formular 5'
         depth_pred = depth_map[..., None]
         depth_cov = torch.sqrt(torch.sum(weights*(z_vals-depth_pred)*(z_vals-depth_pred)))
+        'standard deviation of the depth of every ray, used as confidence of the prior depth update'
+        depth_std = torch.sqrt(torch.sum(weights*(z_vals-depth_pred)*(z_vals-depth_pred), dim=-1))
 
         # depth_img = (depth_map - depth_map.min()) / (depth_map.max() - depth_map.min()) * 255.0
 
@@ -448,10 +637,11 @@ def render_rays(
             normals_weights = None
 
         depth_cov = None
+        depth_std = None
         depth_sky = None
 
     'operation of sky'
-    rgb_sky, sky_style_code = sky_model(ray_d, sky_style_code.cuda(), sky_mask)
+    rgb_sky, sky_style_code = sky_model(ray_batch["ray_d"], sky_style_code.cuda(), sky_mask)
 
     z = sky_style_code.detach()
 
@@ -480,7 +670,7 @@ def render_rays(
     # #     rgb = rgb + rgb_sky
 
     # Zhenyi Wan [2025/4/10] add the pts output for PBR rendering
-    ret["outputs_coarse"] = {"rgb": rgb, "weights": weights, "depth": depth_map, "rgb_sky": rgb_sky, "depth_sky": depth_sky, "depth_cov": depth_cov, "points":PBR_pts}
+    ret["outputs_coarse"] = {"rgb": rgb, "weights": weights, "depth": depth_map, "rgb_sky": rgb_sky, "depth_sky": depth_sky, "depth_cov": depth_cov, "depth_std": depth_std, "points":PBR_pts}
     # Zhenyi Wan [2025/4/9] return BRDF_Buffer
     if BRDF_Buffer is not None:
         ret["outputs_roughness"] = {"roughness":roughness, "roughness_weights": roughness_weights}
@@ -493,12 +683,26 @@ def render_rays(
         ret["outputs_albedo"] = None
         ret["outputs_normals"] = None
 
+    'interval edges and weights of the nerf samples and the proposal samples for the proposal loss, see lossfun_outer_torch()'
+    if use_proposal_sampling and weights is not None:
+        ret["outputs_proposal"] = {
+            "t": z_vals_to_intervals(z_vals), "w": weights.detach(), "t_env": t_env, "w_env": w_env
+        }
+    else:
+        ret["outputs_proposal"] = None
+
+    'contracted points and weights of the samples, accumulated into the occupancy grid by the training loop'
+    if occupancy_grid is not None and mode == 'train' and weights is not None:
+        ret["outputs_occupancy"] = {"pts": pts.detach(), "weights": weights.detach()}
+    else:
+        ret["outputs_occupancy"] = None
+
     if N_importance > 0:
         # detach since we would like to decouple the coarse and fine networks
         weights = ret["outputs_coarse"]["weights"].clone().detach()  # [N_rays, N_samples]
         'LinGaoyuan_20240830: return N_samples+N_importance sampled point in each ray'
         pts, z_vals = sample_fine_pts(
-            inv_uniform, N_importance, det, N_samples, ray_batch, weights, z_vals
+            inv_uniform, N_importance, det, N_samples, nerf_ray_batch, weights, z_vals
         )
 
         rgb_feat_sampled, ray_diff, mask = projector.compute(
@@ -507,6 +711,7 @@ def render_rays(
             ray_batch["src_rgbs"],
             ray_batch["src_cameras"],
             featmaps=featmaps[1],
+            src_depths=ray_batch["src_depth_values"],
         )
 
         # TODO: Include pixel mask in ray transformer
@@ -522,4 +727,8 @@ def render_rays(
         depth_map = torch.sum(weights * z_vals, dim=-1)
         ret["outputs_fine"] = {"rgb": rgb, "weights": weights, "depth": depth_map}
 
+    if num_nerf_rays is not None:
+        for k in ret:
+            ret[k] = pad_nerf_rays(ret[k], num_nerf_rays, N_rays_total)
+
     return ret, z
@@ -0,0 +1,49 @@
+import torch
+
+
+def sample_pdf(bins, weights, N_samples, det=False, det_midpoints=False):
+    """
+    hierarchical sampling: draw samples from the piecewise constant pdf given by weights, the bins of every sample are
+    found with torch.searchsorted, no [N_rays, N_samples, M+1] tensor is built
+    :param bins: tensor of shape [..., M+1], M is the number of bins
+    :param weights: tensor of shape [..., M]
+    :param N_samples: number of samples along each ray
+    :param det: if True, will perform deterministic sampling
+    :param det_midpoints: the deterministic samples are at the midpoints (i + 0.5) / N_samples of the cdf instead of
+    linspace(0, 1, N_samples), the behaviour of the NeRO field
+    :return: [..., N_samples]
+    """
+    M = weights.shape[-1]
+    weights = weights + 1e-5  # prevent nans
+    # Get pdf
+    pdf = weights / torch.sum(weights, dim=-1, keepdim=True)  # [..., M]
+    cdf = torch.cumsum(pdf, dim=-1)  # [..., M]
+    cdf = torch.cat([torch.zeros_like(cdf[..., 0:1]), cdf], dim=-1)  # [..., M+1]
+
+    # Take uniform samples
+    if det:
+        if det_midpoints:
+            u = torch.linspace(0.5 / N_samples, 1.0 - 0.5 / N_samples, N_samples, device=bins.device)
+        else:
+            u = torch.linspace(0.0, 1.0, N_samples, device=bins.device)
+        u = u.expand(list(cdf.shape[:-1]) + [N_samples]).contiguous()  # [..., N_samples]
+    else:
+        u = torch.rand(list(cdf.shape[:-1]) + [N_samples], device=bins.device)
+
+    # Invert CDF
+    above_inds = torch.searchsorted(cdf.contiguous(), u, right=True).clamp(max=M)  # [..., N_samples]
+    below_inds = torch.clamp(above_inds - 1, min=0)
+
+    cdf_below = torch.gather(cdf, -1, below_inds)  # [..., N_samples]
+    cdf_above = torch.gather(cdf, -1, above_inds)
+    bins_below = torch.gather(bins, -1, below_inds)
+    bins_above = torch.gather(bins, -1, above_inds)
+
+    # fix numeric issue
+    denom = cdf_above - cdf_below  # [..., N_samples]
+    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+    t = (u - cdf_below) / denom
+
+    samples = bins_below + t * (bins_above - bins_below)
+
+    return samples
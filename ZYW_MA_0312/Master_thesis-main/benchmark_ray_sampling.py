@@ -0,0 +1,122 @@
+import time
+import torch
+
+from ZYW_model.render_ray_ZYW import sample_prior_depth_perturb
+from ZYW_model.sample_pdf_ZYW import sample_pdf
+
+
+'''
+microbenchmark of the ray sampling functions of ZYW_model/render_ray_ZYW.py against the loop implementations they replaced
+    python benchmark_ray_sampling.py
+'''
+
+
+def sample_prior_depth_perturb_loop(ray_o, ray_d, depth_prior, depth_offset_ratio=0.05, N_samples_d=32):
+    'reference: the previous implementation, one torch.linspace per ray, det and inv_uniform are ignored'
+    mids = depth_prior
+    uppers = mids * (1 + depth_offset_ratio)
+    lowers = mids * (1 - depth_offset_ratio)
+
+    batch_size = depth_prior.size(0)
+    z_vals = torch.zeros((batch_size, N_samples_d), device=depth_prior.device)
+    for i in range(batch_size):
+        z_vals[i] = torch.linspace(lowers[i, 0], uppers[i, 0], N_samples_d)
+
+    ray_d = ray_d[..., None, :].repeat(1, N_samples_d, 1)
+    ray_o = ray_o[..., None, :].repeat(1, N_samples_d, 1)
+    pts = ray_o + ray_d * z_vals[..., :, None]
+    return pts, z_vals
+
+
+def sample_pdf_loop(bins, weights, N_samples, det=False, u=None):
+    'reference: the previous sample_pdf of render_ray_ZYW.py, O(M) loop and [N_rays, N_samples, M+1] gathers'
+    M = weights.shape[1]
+    weights = weights + 1e-5
+    pdf = weights / torch.sum(weights, dim=-1, keepdim=True)
+    cdf = torch.cumsum(pdf, dim=-1)
+    cdf = torch.cat([torch.zeros_like(cdf[:, 0:1]), cdf], dim=-1)
+
+    if u is None:
+        if det:
+            u = torch.linspace(0.0, 1.0, N_samples, device=bins.device)
+            u = u.unsqueeze(0).repeat(bins.shape[0], 1)
+        else:
+            u = torch.rand(bins.shape[0], N_samples, device=bins.device)
+
+    above_inds = torch.zeros_like(u, dtype=torch.long)
+    for i in range(M):
+        above_inds += (u >= cdf[:, i : i + 1]).long()
+
+    below_inds = torch.clamp(above_inds - 1, min=0)
+    inds_g = torch.stack((below_inds, above_inds), dim=2)
+
+    cdf = cdf.unsqueeze(1).repeat(1, N_samples, 1)
+    cdf_g = torch.gather(input=cdf, dim=-1, index=inds_g)
+
+    bins = bins.unsqueeze(1).repeat(1, N_samples, 1)
+    bins_g = torch.gather(input=bins, dim=-1, index=inds_g)
+
+    denom = cdf_g[:, :, 1] - cdf_g[:, :, 0]
+    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+    t = (u - cdf_g[:, :, 0]) / denom
+
+    return bins_g[:, :, 0] + t * (bins_g[:, :, 1] - bins_g[:, :, 0])
+
+
+def benchmark(fn, *args, repeat=10, **kwargs):
+    fn(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    time0 = time.time()
+    for _ in range(repeat):
+        fn(*args, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - time0) / repeat
+
+
+def benchmark_prior_depth_perturb(N_rays, N_samples_d, device):
+    ray_o = torch.randn(N_rays, 3, device=device)
+    ray_d = torch.randn(N_rays, 3, device=device)
+    depth_prior = torch.rand(N_rays, 1, device=device) * 100 + 1
+
+    'the batched version with det=True and inv_uniform=False must give the same samples as the loop'
+    pts_loop, z_vals_loop = sample_prior_depth_perturb_loop(ray_o, ray_d, depth_prior, 0.2, N_samples_d)
+    pts, z_vals = sample_prior_depth_perturb(ray_o, ray_d, depth_prior, 0.2, N_samples_d, inv_uniform=False, det=True)
+    max_error = (z_vals - z_vals_loop).abs().max().item()
+
+    time_loop = benchmark(sample_prior_depth_perturb_loop, ray_o, ray_d, depth_prior, 0.2, N_samples_d, repeat=3)
+    time_batched = benchmark(sample_prior_depth_perturb, ray_o, ray_d, depth_prior, 0.2, N_samples_d, det=False)
+    print(
+        "sample_prior_depth_perturb N_rays={} N_samples_d={}: loop {:.2f} ms, batched {:.2f} ms, speedup {:.1f}x, "
+        "max z_vals difference {:.2e}".format(
+            N_rays, N_samples_d, time_loop * 1000, time_batched * 1000, time_loop / time_batched, max_error
+        )
+    )
+
+
+def benchmark_sample_pdf(N_rays, M, N_samples, device):
+    bins, _ = torch.sort(torch.rand(N_rays, M + 1, device=device) * 100, dim=-1)
+    weights = torch.rand(N_rays, M, device=device)
+
+    'deterministic samples must match the loop'
+    samples_loop = sample_pdf_loop(bins, weights, N_samples, det=True)
+    samples = sample_pdf(bins, weights, N_samples, det=True)
+    max_error = (samples - samples_loop).abs().max().item()
+
+    time_loop = benchmark(sample_pdf_loop, bins, weights, N_samples, repeat=3)
+    time_searchsorted = benchmark(sample_pdf, bins, weights, N_samples)
+    print(
+        "sample_pdf N_rays={} M={} N_samples={}: loop {:.2f} ms, searchsorted {:.2f} ms, speedup {:.1f}x, "
+        "max samples difference {:.2e}".format(
+            N_rays, M, N_samples, time_loop * 1000, time_searchsorted * 1000, time_loop / time_searchsorted, max_error
+        )
+    )
+
+
+if __name__ == '__main__':
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    for N_rays in [3072, 4096 * 4]:
+        benchmark_prior_depth_perturb(N_rays, 64, device)
+    for N_rays in [3072, 4096 * 4]:
+        benchmark_sample_pdf(N_rays, 62, 64, device)
@@ -88,6 +88,33 @@ def config_parser():
     )
 
 
+    parser.add_argument(
+        "--use_binary_prior_cache", action="store_true",
+        help="read depth priors and sky masks from the .npy files written by data_loaders/prior_cache.py instead of json"
+    )
+
+    parser.add_argument(
+        "--image_cache_bytes", type=int, default=0,
+        help="byte budget of the decoded image cache shared by the DataLoader workers, 0 disables the cache"
+    )
+
+    parser.add_argument(
+        "--uint8_images", action="store_true",
+        help="ship rgb images as uint8 from the DataLoader workers and convert / resize them on the GPU"
+    )
+    parser.add_argument(
+        "--prefetch_ray_batch", action="store_true",
+        help="build the ray batch of the next training steps on a side thread / CUDA stream"
+    )
+    parser.add_argument(
+        "--num_prefetch_ray_batch", type=int, default=2, help="number of ray batches prepared in advance"
+    )
+    parser.add_argument(
+        "--gpu_resize", action="store_true",
+        help="with resize_image, resize images, sky masks and depth values of all views in one batched call on the GPU "
+             "instead of per image in the DataLoader workers (always used together with uint8_images)"
+    )
+
     ## others
     parser.add_argument(
         "--testskip",
@@ -103,11 +130,40 @@ def config_parser():
         "--sample_mode",
         type=str,
         default="uniform",
-        help="how to sample pixels from images for training:" "uniform|center",
+        help="how to sample pixels from images for training:" "uniform|center|importance|sky_stratified|patch",
     )
     parser.add_argument(
         "--center_ratio", type=float, default=0.8, help="the ratio of center crop to keep"
     )
+    parser.add_argument(
+        "--importance_cell_size", type=int, default=16,
+        help="cell size in pixels of the error map of the importance sample mode"
+    )
+    parser.add_argument(
+        "--importance_uniform_floor", type=float, default=0.2,
+        help="fraction of the sampling probability that is spread uniformly over the image in the importance sample mode"
+    )
+    parser.add_argument(
+        "--importance_momentum", type=float, default=0.1,
+        help="blend weight of the per-ray error in the error map update of the importance sample mode"
+    )
+    parser.add_argument(
+        "--sky_ray_fraction", type=float, default=0.1,
+        help="fraction of the rays drawn from the sky area in the sky_stratified sample mode, these rays are only "
+             "rendered by the sky model"
+    )
+    parser.add_argument(
+        "--patch_size", type=int, default=16,
+        help="side length of the patches of the patch sample mode, N_rand // patch_size**2 patches are drawn"
+    )
+    parser.add_argument(
+        "--patch_dilation", type=int, default=1,
+        help="distance in pixels between neighbouring pixels of a patch in the patch sample mode"
+    )
+    parser.add_argument(
+        "--gpu_pixel_sampling", action="store_true",
+        help="draw the training pixels with torch.randperm on the GPU instead of rng.choice on the cpu"
+    )
     parser.add_argument(
         "--N_rand",
         type=int,
@@ -125,6 +181,22 @@ def config_parser():
         "--sample_with_prior_depth", action="store_true",
         help="sample 3D pts based on the prior value of depth"
     )
+    parser.add_argument(
+        "--prior_depth_stratified", action="store_true",
+        help="jitter the samples around the prior depth in training and honour inv_uniform like the uniform sampling, "
+             "by default they are evenly spaced in depth"
+    )
+
+    parser.add_argument(
+        "--depth_bounded_sampling", action="store_true",
+        help="spread the N_samples of every ray between per-ray near / far bounds around the depth prior instead of the "
+             "global depth range, sky rays and rays without a valid prior use the global depth range"
+    )
+
+    parser.add_argument(
+        "--depth_bound_margin", type=float, default=0.3,
+        help="relative margin of the per-ray bounds of depth_bounded_sampling: [depth * (1 - margin), depth * (1 + margin)]"
+    )
 
     ## model options
     parser.add_argument(
@@ -337,6 +409,83 @@ def config_parser():
         "--N_samples_depth", type=int, default=64, help="number of samples per ray with prior depth"
     )
 
+    parser.add_argument(
+        "--use_proposal_sampling", action="store_true",
+        help="place the N_samples samples of the projector and the ray transformer with a tiny proposal density mlp that "
+             "is evaluated on N_proposal_samples samples per ray and trained with the proposal loss of mip-NeRF 360"
+    )
+    parser.add_argument(
+        "--N_proposal_samples", type=int, default=128, help="number of samples per ray of the proposal mlp"
+    )
+    parser.add_argument(
+        "--lambda_proposal", type=float, default=1.0, help="loss coefficient for the proposal loss"
+    )
+    parser.add_argument(
+        "--lrate_proposal", type=float, default=1e-3, help="learning rate for the proposal mlp"
+    )
+
+    parser.add_argument(
+        "--use_occupancy_grid", action="store_true",
+        help="drop the samples in free space with an occupancy grid over the contracted space, seeded from the depth "
+             "priors and updated from the predicted weights"
+    )
+    parser.add_argument(
+        "--occupancy_grid_resolution", type=int, default=128, help="number of cells along every axis of the occupancy grid"
+    )
+    parser.add_argument(
+        "--occupancy_threshold", type=float, default=0.01, help="a cell is occupied if its value is larger than this"
+    )
+    parser.add_argument(
+        "--occupancy_decay", type=float, default=0.95, help="decay of the value of an observed cell in every update"
+    )
+    parser.add_argument(
+        "--occupancy_update_interval", type=int, default=16, help="number of training steps between grid updates"
+    )
+    parser.add_argument(
+        "--occupancy_explore_interval", type=int, default=8,
+        help="every occupancy_explore_interval-th training step keeps all samples, so that the free cells of the "
+             "occupancy grid are observed again and can become occupied"
+    )
+    parser.add_argument(
+        "--occupancy_seed_margin", type=float, default=0.1,
+        help="relative margin around the depth priors that is marked as occupied when the grid is seeded"
+    )
+    parser.add_argument(
+        "--fused_projection_sampling", action="store_true",
+        help="sample the source images and the feature maps from one pre-concatenated channels-last texture with a "
+             "single grid_sample call in Projector.compute, only used if the feature maps have the resolution of the "
+             "images, otherwise both are sampled separately"
+    )
+    parser.add_argument(
+        "--projection_texture_dtype", type=str, default="float32", choices=["float32", "float16", "bfloat16"],
+        help="precision the fused texture of fused_projection_sampling is rounded to, it is kept and sampled in float32"
+    )
+    parser.add_argument(
+        "--top_k_views", type=int, default=0,
+        help="if > 0, the view transformers only see the top_k_views valid source views of every sample with the "
+             "smallest angle between the query ray and the source ray"
+    )
+    parser.add_argument(
+        "--occlusion_test", action="store_true",
+        help="mask out the source views in which a sample lies behind the depth prior of the source image"
+    )
+    parser.add_argument(
+        "--occlusion_tolerance", type=float, default=0.1,
+        help="relative depth tolerance of occlusion_test, a sample is occluded if its depth in the source camera is "
+             "larger than (1 + occlusion_tolerance) times the depth prior"
+    )
+    parser.add_argument(
+        "--stream_projection", action="store_true",
+        help="project the samples in chunks along the rays and reduce every chunk with the view stage of the ReTR model "
+             "right away, the chunks are checkpointed so the projected features of all samples are never held at once"
+    )
+    parser.add_argument(
+        "--projection_chunk_samples", type=int, default=16, help="number of samples per ray in a chunk of stream_projection"
+    )
+    parser.add_argument(
+        "--occupancy_min_samples", type=int, default=8, help="minimal number of samples per ray after the free space is dropped"
+    )
+
     ########## logging/saving options ##########
     parser.add_argument("--i_print", type=int, default=100, help="frequency of terminal printout")
     parser.add_argument(
@@ -360,6 +509,36 @@ def config_parser():
         "--i_prior_depth_update", type=int, default=10000, help="frequency of prior depth update"
     )
 
+    parser.add_argument(
+        "--prior_depth_load_workers", type=int, default=8,
+        help="number of workers that load the initial prior depth values at startup, <= 1 loads them serially"
+    )
+
+    parser.add_argument(
+        "--no_prior_depth_cache", action="store_true",
+        help="do not read / write the consolidated cache of the initial prior depth values in the out folder"
+    )
+
+    parser.add_argument(
+        "--prior_depth_store", type=str, default="cuda", choices=["cuda", "pinned", "mmap"],
+        help="where the prior depth values of all images are kept: on the GPU, in pinned host memory or in a memory-mapped "
+             "file in the out folder. with pinned / mmap only the image of the current ray batch is paged to the GPU"
+    )
+
+    parser.add_argument(
+        "--prior_depth_half", action="store_true", help="store the prior depth values as float16"
+    )
+
+    parser.add_argument(
+        "--prior_depth_momentum", type=float, default=1.0,
+        help="blend weight of the depth prediction in the prior depth update, 1 overwrites the prior"
+    )
+
+    parser.add_argument(
+        "--prior_depth_confidence", action="store_true",
+        help="weight the prior depth update of every ray by exp(-depth std / preset_depth_cov)"
+    )
+
     ########## evaluation options ##########
     parser.add_argument(
         "--llffhold",
@@ -112,7 +112,14 @@ def eval(args):
 
 
     # create projector
-    projector = Projector(device=device)
+    projector = Projector(
+        device=device,
+        fused_sampling=args.fused_projection_sampling,
+        texture_dtype=args.projection_texture_dtype,
+        top_k_views=args.top_k_views,
+        occlusion_test=args.occlusion_test,
+        occlusion_tolerance=args.occlusion_tolerance,
+    )
 
     indx = 0
     psnr_scores = []
@@ -127,7 +134,7 @@ def eval(args):
             print('the {}st val data loaded'.format(indx))
             tmp_ray_sampler = RaySamplerSingleImage(data, device, render_stride=args.render_stride)
             H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
-            gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
+            gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3).cpu()
             'LinGaoyuan_operation_20240927: add new parameter to log_view, set ret_alpha == True to always return depth map, set prefix == val'
             psnr_curr_img, lpips_curr_img, ssim_curr_img = log_view(
                 indx,
@@ -10,7 +10,10 @@ import torchvision
 import matplotlib.pyplot as plt
 
 sys.path.append("../")
-from .data_utils import rectify_inplane_rotation, get_nearest_pose_ids
+from .data_utils import rectify_inplane_rotation, get_nearest_pose_ids, load_nearest_pose_table, get_nearest_pose_ids_from_table
+from .data_utils import resize_camera
+from .prior_cache import load_depth_value, load_sky_mask
+from .shared_image_cache import SharedImageCache
 
 def read_cameras(pose_file):
     ''
@@ -63,6 +66,22 @@ def read_cameras(pose_file):
     return rgb_files, np.array([intrinsics] * len(images_info_dictionary)), c2w_mats, sky_mask_files, depth_value_files
 
 
+def build_scene_metadata(pose_file):
+    '''
+    read the camera information of one scene once and keep it as compact numpy arrays. numpy string arrays are used
+    instead of python lists so that DataLoader workers can share the metadata read-only without copy-on-write of
+    every list element.
+    '''
+    rgb_files, intrinsics, poses, sky_mask_files, depth_value_files = read_cameras(pose_file)
+    return {
+        "rgb_files": np.array(rgb_files),
+        "intrinsics": intrinsics,
+        "poses": poses,
+        "sky_mask_files": np.array(sky_mask_files),
+        "depth_value_files": np.array(depth_value_files),
+    }
+
+
 class NusceneDataset_train_val(Dataset):
     def __init__(
         self,
@@ -95,18 +114,68 @@ class NusceneDataset_train_val(Dataset):
         self.sky_mask_files = []
         self.depth_value_files = []
 
+        'the source views of each render image are selected from the metadata of its scene, see build_scene_metadata()'
+        self.scene_metadata = []
+        self.render_scene_ids = []
+        self.render_ref_ids = []
+
+        'the source views are selected with the "vector" distance, at most num_source_views * max(subsample_factor) + 1 of them'
+        self.angular_dist_method = "vector"
+        self.max_num_select = int(self.num_source_views * 3) + 1
+
         'LinGaoyuan_operation_20240906: add 3 variable for image resize, but the debug process is failed, need follow optimization'
         self.image_resize_H = args.image_resize_H
         self.image_resize_W = args.image_resize_W
         self.resize_image = args.resize_image
         self.resize_fun = torchvision.transforms.Resize((self.image_resize_H,self.image_resize_W))
 
+        'read depth priors and sky masks from the .npy files written by prior_cache.py instead of the json files'
+        self.use_binary_prior_cache = args.use_binary_prior_cache
+
+        'decoded frames are shared by all DataLoader workers through an LRU cache in shared memory, only used for training'
+        if args.image_cache_bytes > 0 and self.mode == "train":
+            self.image_cache = SharedImageCache(args.image_cache_bytes, (args.image_H, args.image_W, 3))
+        else:
+            self.image_cache = None
+        self.num_cached_keys = 0
+
+        '''
+        keep rgb and src_rgbs as uint8 until they reach the GPU. with uint8 images or args.gpu_resize the resize is left to
+        RaySamplerSingleImage, which resizes images, sky masks and depth values of all views in one batched GPU call and
+        scales the intrinsics, see RaySamplerSingleImage.prepare_images_on_device()
+        '''
+        self.uint8_images = args.uint8_images
+        self.defer_resize = self.resize_image is True and (self.uint8_images is True or args.gpu_resize is True)
+
         for scene in scenes:
             self.scene_path = os.path.join(self.folder_path, scene)
             pose_file = os.path.join(self.scene_path, "images_info_dictionary_{}.json".format(mode))
             # pose_file = os.path.join(pose_file)
 
-            rgb_files, intrinsics, poses, sky_mask_files, depth_value_files = read_cameras(pose_file)
+            'both the train and the val images take their source views from all images of the same split'
+            scene_id = len(self.scene_metadata)
+            scene_metadata = build_scene_metadata(pose_file)
+            self.scene_metadata.append(scene_metadata)
+
+            'every image of the dataset gets a unique key for the image cache'
+            scene_metadata["image_key_offset"] = self.num_cached_keys
+            self.num_cached_keys += len(scene_metadata["rgb_files"])
+
+            rgb_files = scene_metadata["rgb_files"]
+            intrinsics = scene_metadata["intrinsics"]
+            poses = scene_metadata["poses"]
+            sky_mask_files = scene_metadata["sky_mask_files"]
+            depth_value_files = scene_metadata["depth_value_files"]
+
+            'one more neighbour than needed, because the target itself is removed from its row in train mode'
+            scene_metadata["nearest_pose_table"] = load_nearest_pose_table(
+                os.path.join(self.scene_path, "nearest_pose_table_{}_{}.npz".format(mode, self.angular_dist_method)),
+                poses,
+                self.max_num_select + 1,
+                angular_dist_method=self.angular_dist_method,
+            )
+            ref_ids = np.arange(len(rgb_files))
+
             if self.mode != "train":
                 'if mode is not train, just select some of image from val dataset as the val data'
                 rgb_files = rgb_files[:: self.testskip]
@@ -114,17 +183,49 @@ class NusceneDataset_train_val(Dataset):
                 poses = poses[:: self.testskip]
                 sky_mask_files = sky_mask_files[:: self.testskip]
                 depth_value_files = depth_value_files[:: self.testskip]
+                ref_ids = ref_ids[:: self.testskip]
             self.render_rgb_files.extend(rgb_files)
             self.render_poses.extend(poses)
             self.render_intrinsics.extend(intrinsics)
             self.sky_mask_files.extend(sky_mask_files)
             self.depth_value_files.extend(depth_value_files)
+            self.render_scene_ids.extend([scene_id] * len(rgb_files))
+            self.render_ref_ids.extend(ref_ids)
 
             # print('end loading data')
 
+        self.render_rgb_files = np.array(self.render_rgb_files)
+        self.render_poses = np.array(self.render_poses)
+        self.render_intrinsics = np.array(self.render_intrinsics)
+        self.sky_mask_files = np.array(self.sky_mask_files)
+        self.depth_value_files = np.array(self.depth_value_files)
+        self.render_scene_ids = np.array(self.render_scene_ids, dtype=np.int32)
+        self.render_ref_ids = np.array(self.render_ref_ids, dtype=np.int64)
+
     def __len__(self):
         return len(self.render_rgb_files)
 
+    def read_rgb(self, scene_metadata, ref_id):
+        """
+        :param scene_metadata: metadata of the scene, see build_scene_metadata()
+        :param ref_id: index of the image in the scene
+        :return: decoded image, np.uint8 [H, W, C]
+        """
+        rgb_file = scene_metadata["rgb_files"][ref_id]
+        if self.image_cache is None:
+            return imageio.imread(rgb_file)
+        return self.image_cache.get(scene_metadata["image_key_offset"] + ref_id, lambda: imageio.imread(rgb_file))
+
+    def cast_depth_value(self, depth_value):
+        """
+        the binary cache returns the float16 memmap of the depth prior. the deferred resize reads it as float16 and casts
+        it on the GPU, see RaySamplerSingleImage.prepare_images_on_device(), otherwise it is cast to float32 here
+        :param depth_value: output of load_depth_value(), [H, W]
+        """
+        if self.use_binary_prior_cache is True and self.defer_resize is False:
+            return np.asarray(depth_value, dtype=np.float32)
+        return depth_value
+
     ' when train.py run the for loop of train_loader, it will randomly choose a data of train dataset and this getitem() will be called'
     def __getitem__(self, idx):
         # print('run getitem with idx{}'.format(idx))
@@ -140,55 +241,55 @@ class NusceneDataset_train_val(Dataset):
         if self.mode == "train":
             id_render = int(os.path.basename(rgb_file)[:-4].split("_")[1])
             subsample_factor = np.random.choice(np.arange(1, 4), p=[0.3, 0.5, 0.2])
-
-            train_pose_file = os.path.join("/".join(rgb_file.split("/")[:-2]), "images_info_dictionary_train.json")
-            rgb_files, intrinsics, poses, sky_mask_files, depth_value_files = read_cameras(
-                train_pose_file)
-
         else:
             id_render = -1
             subsample_factor = 1
 
-            val_pose_file = os.path.join("/".join(rgb_file.split("/")[:-2]), "images_info_dictionary_val.json")
-            rgb_files, intrinsics, poses, sky_mask_files, depth_value_files = read_cameras(
-                val_pose_file)
+        'the camera information of the scene is read once in __init__, see build_scene_metadata()'
+        scene_metadata = self.scene_metadata[self.render_scene_ids[idx]]
+        rgb_files = scene_metadata["rgb_files"]
+        intrinsics = scene_metadata["intrinsics"]
+        poses = scene_metadata["poses"]
+        sky_mask_files = scene_metadata["sky_mask_files"]
+        depth_value_files = scene_metadata["depth_value_files"]
 
-        rgb = imageio.imread(rgb_file).astype(np.float32) / 255.0
+        rgb = self.read_rgb(scene_metadata, self.render_ref_ids[idx])
+        if self.uint8_images is False:
+            rgb = rgb.astype(np.float32) / 255.0
 
         self.sky_color = np.zeros((3,))
         'change color of sky pixels to black'
-        with open(sky_mask_file, 'r') as f:
-            sky_mask_dictionary = json.load(f)
-        sky_mask_0_1 = np.array(sky_mask_dictionary['sky_mask'])
+        sky_mask_0_1 = load_sky_mask(sky_mask_file, rgb.shape[1], self.use_binary_prior_cache)
         # rgb = rgb * sky_mask_0_1[..., None] + self.sky_color * (1 - sky_mask_0_1[..., None])
         #
         # plt.imshow(rgb)
         # plt.show()
 
-        with open(depth_value_file, 'r') as f:
-            depth_value_dictionary = json.load(f)
-        depth_value = np.array(depth_value_dictionary['depth_value_pred'])
+        depth_value = load_depth_value(depth_value_file, self.use_binary_prior_cache)
+        depth_value = self.cast_depth_value(depth_value)
+
+        img_size = rgb.shape[:2]
+        camera = np.concatenate(
+            (list(img_size), render_intrinsics.flatten(), render_pose.flatten())
+        ).astype(np.float32)
 
         'LinGaoyuan_operation_20240906: resize input image if resize_image is set to True'
-        if self.resize_image is True:
+        if self.resize_image is True and self.defer_resize is False:
             rgb = np.array(resize_img(torch.tensor(rgb).permute(2,0,1), self.image_resize_H, self.image_resize_W, self.resize_fun).permute(1,2,0))
             sky_mask_0_1 = resize_img(torch.tensor(sky_mask_0_1[None, ...]), self.image_resize_H, self.image_resize_W, self.resize_fun).squeeze()
             depth_value = resize_img(torch.tensor(depth_value[None, ...]), self.image_resize_H, self.image_resize_W, self.resize_fun).squeeze()
+            'the same camera as the deferred resize of RaySamplerSingleImage'
+            camera = resize_camera(camera, self.image_resize_H, self.image_resize_W)
 
         'the next code will add some indistinct effect to the whole image'
         # rgb = rgb[..., [-1]] * rgb[..., :3] + 1 - rgb[..., [-1]]
 
-        img_size = rgb.shape[:2]
-        camera = np.concatenate(
-            (list(img_size), render_intrinsics.flatten(), render_pose.flatten())
-        ).astype(np.float32)
-
-        nearest_pose_ids = get_nearest_pose_ids(
-            render_pose,
-            poses,
+        'the neighbours of the render image are read from the table built in __init__, see load_nearest_pose_table()'
+        nearest_pose_ids = get_nearest_pose_ids_from_table(
+            scene_metadata["nearest_pose_table"],
+            self.render_ref_ids[idx],
             int(self.num_source_views * subsample_factor)+1,
             tar_id=id_render,
-            angular_dist_method="vector",
         )
 
         'remove target img from nearest_pose_ids if it is exist in nearest_pose_ids'
@@ -212,22 +313,21 @@ class NusceneDataset_train_val(Dataset):
         src_sky_masks = []
         src_depth_values = []
         for id in nearest_pose_ids:
-            src_rgb = imageio.imread(rgb_files[id]).astype(np.float32) / 255.0
+            src_rgb = self.read_rgb(scene_metadata, id)
+            if self.uint8_images is False:
+                src_rgb = src_rgb.astype(np.float32) / 255.0
 
 
             'change color of sky pixels to black'
-            with open(sky_mask_files[id], 'r') as f:
-                src_sky_mask_dictionary = json.load(f)
-            src_sky_mask_0_1 = np.array(src_sky_mask_dictionary['sky_mask'])
+            src_sky_mask_0_1 = load_sky_mask(sky_mask_files[id], src_rgb.shape[1], self.use_binary_prior_cache)
             # src_sky_masks.append(src_sky_mask_0_1)
             # src_rgb = src_rgb * src_sky_mask_0_1[..., None] + self.sky_color * (1 - sky_mask_0_1[..., None])
             #
             # plt.imshow(src_rgb)
             # plt.show()
 
-            with open(depth_value_files[id], 'r') as f:
-                src_depth_value_dictionary = json.load(f)
-            src_depth_value = np.array(src_depth_value_dictionary['depth_value_pred'])
+            src_depth_value = load_depth_value(depth_value_files[id], self.use_binary_prior_cache)
+            src_depth_value = self.cast_depth_value(src_depth_value)
             # src_depth_values.append(src_depth_value)
 
             'the next code will add some indistinct effect to the whole image'
@@ -238,17 +338,19 @@ class NusceneDataset_train_val(Dataset):
             if self.rectify_inplane_rotation:
                 pose, src_rgb = rectify_inplane_rotation(pose, render_pose, src_rgb)
 
+            img_size = src_rgb.shape[:2]
+            src_camera = np.concatenate(
+                (list(img_size), intrinsics_.flatten(), pose.flatten())
+            ).astype(np.float32)
+
             'LinGaoyuan_operation_20240906: resize input image if resize_image is set to True'
-            if self.resize_image is True:
+            if self.resize_image is True and self.defer_resize is False:
                 src_rgb = resize_img(torch.tensor(src_rgb).permute(2,0,1), self.image_resize_H, self.image_resize_W, self.resize_fun).permute(1,2,0)
                 src_sky_mask_0_1 = resize_img(torch.tensor(src_sky_mask_0_1[None, ...]), self.image_resize_H, self.image_resize_W, self.resize_fun).squeeze()
                 src_depth_value = resize_img(torch.tensor(src_depth_value[None, ...]), self.image_resize_H, self.image_resize_W, self.resize_fun).squeeze()
+                src_camera = resize_camera(src_camera, self.image_resize_H, self.image_resize_W)
 
             src_rgbs.append(src_rgb)
-            img_size = src_rgb.shape[:2]
-            src_camera = np.concatenate(
-                (list(img_size), intrinsics_.flatten(), pose.flatten())
-            ).astype(np.float32)
             src_cameras.append(src_camera)
 
             src_sky_masks.append(src_sky_mask_0_1)
@@ -268,15 +370,22 @@ class NusceneDataset_train_val(Dataset):
 
         depth_range = torch.tensor([near_depth, far_depth])
 
-        return {
-            "rgb": torch.from_numpy(rgb[..., :3]).to(dtype=torch.float),
+        if self.uint8_images is True:
+            rgb = torch.from_numpy(np.ascontiguousarray(rgb[..., :3]))
+            src_rgbs = torch.from_numpy(np.ascontiguousarray(src_rgbs[..., :3]))
+        else:
+            rgb = torch.from_numpy(rgb[..., :3]).to(dtype=torch.float)
+            src_rgbs = torch.from_numpy(src_rgbs[..., :3]).to(dtype=torch.float)
+
+        ret = {
+            "rgb": rgb,
             "sky_mask": sky_mask_0_1,
             "depth_value": depth_value,
             "camera": torch.from_numpy(camera),
             "rgb_path": rgb_file,
             "sky_mask_path": sky_mask_file,
             "depth_value_path": depth_value_file,
-            "src_rgbs": torch.from_numpy(src_rgbs[..., :3]).to(dtype=torch.float),
+            "src_rgbs": src_rgbs,
             "src_cameras": torch.from_numpy(src_cameras),
             "src_sky_masks": torch.from_numpy(src_sky_masks),
             "src_depth_values": torch.from_numpy(src_depth_values),
@@ -284,6 +393,11 @@ class NusceneDataset_train_val(Dataset):
             "idx": idx,
         }
 
+        if self.defer_resize is True:
+            ret["gpu_resize_hw"] = torch.tensor([self.image_resize_H, self.image_resize_W])
+
+        return ret
+
 
 
 def resize_img(image, target_H, target_W, resize_fun):
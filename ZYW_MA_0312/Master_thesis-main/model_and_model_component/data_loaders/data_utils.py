@@ -1,3 +1,6 @@
+import os
+import tempfile
+import zipfile
 import numpy as np
 import math
 from PIL import Image
@@ -74,11 +77,15 @@ def rectify_inplane_rotation(src_pose, tar_pose, src_img, th=40):
     h, w = src_img.shape[:2]
     center = ((w - 1.0) / 2.0, (h - 1.0) / 2.0)
     M = cv2.getRotationMatrix2D(center, -euler_z, 1)
-    src_img = np.clip((255 * src_img).astype(np.uint8), a_max=255, a_min=0)
+    # uint8 images are rotated and returned as uint8, float images in [0, 1] are returned as float
+    is_uint8 = src_img.dtype == np.uint8
+    if not is_uint8:
+        src_img = np.clip((255 * src_img).astype(np.uint8), a_max=255, a_min=0)
     rotated = cv2.warpAffine(
         src_img, M, (w, h), borderValue=(255, 255, 255), flags=cv2.INTER_LANCZOS4
     )
-    rotated = rotated.astype(np.float32) / 255.0
+    if not is_uint8:
+        rotated = rotated.astype(np.float32) / 255.0
     return out_pose, rotated
 
 
@@ -117,6 +124,23 @@ def random_crop(rgb, camera, src_rgbs, src_cameras, size=(400, 600), center=None
     return rgb_out, camera, src_rgbs, src_cameras
 
 
+def resize_camera(camera, new_H, new_W):
+    """
+    camera of the resized image, used by the cpu resize of the datasets and the deferred gpu resize of
+    RaySamplerSingleImage, so that both produce the same geometry
+    :param camera: np.ndarray or tensor [..., 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+    :return: copy of camera with the image size new_H x new_W and the intrinsics scaled accordingly
+    """
+    camera = camera.clone() if torch.is_tensor(camera) else camera.copy()
+    scale_H = new_H / camera[..., 0:1]
+    scale_W = new_W / camera[..., 1:2]
+    camera[..., 2:5] *= scale_W  # first row of the intrinsics: fx, s, cx
+    camera[..., 6:9] *= scale_H  # second row of the intrinsics: 0, fy, cy
+    camera[..., 0] = new_H
+    camera[..., 1] = new_W
+    return camera
+
+
 def random_flip(rgb, camera, src_rgbs, src_cameras):
     h, w = rgb.shape[:2]
     h_r, w_r = src_rgbs.shape[1:3]
@@ -265,3 +289,103 @@ def get_nearest_pose_ids(
     selected_ids = sorted_ids[:num_select]
     # print(angular_dists[selected_ids] * 180 / np.pi)
     return selected_ids
+
+
+def batched_pose_dists(tar_poses, ref_poses, angular_dist_method="vector", scene_center=(0, 0, 0)):
+    """
+    distances between every target pose and every reference pose, same measures as get_nearest_pose_ids()
+    :param tar_poses: target poses [M, 4, 4]
+    :param ref_poses: reference poses [N, 4, 4]
+    :return: distance matrix [M, N]
+    """
+    if angular_dist_method == "matrix":
+        # trace(R_ref^T R_tar) = sum of the element-wise product of the two rotation matrices
+        traces = np.einsum("mij,nij->mn", tar_poses[:, :3, :3], ref_poses[:, :3, :3])
+        dists = np.arccos(np.clip((traces - 1) / 2.0, a_min=-1 + TINY_NUMBER, a_max=1 - TINY_NUMBER))
+    elif angular_dist_method == "vector":
+        scene_center = np.array(scene_center)[None, ...]
+        tar_vectors = tar_poses[:, :3, 3] - scene_center
+        ref_vectors = ref_poses[:, :3, 3] - scene_center
+        tar_unit = tar_vectors / (np.linalg.norm(tar_vectors, axis=1, keepdims=True) + TINY_NUMBER)
+        ref_unit = ref_vectors / (np.linalg.norm(ref_vectors, axis=1, keepdims=True) + TINY_NUMBER)
+        dists = np.arccos(np.clip(tar_unit.dot(ref_unit.T), -1.0, 1.0))
+    elif angular_dist_method == "dist":
+        dists = np.linalg.norm(tar_poses[:, None, :3, 3] - ref_poses[None, :, :3, 3], axis=-1)
+    else:
+        raise Exception("unknown angular distance calculation method!")
+    return dists
+
+
+def build_nearest_pose_table(
+    tar_poses,
+    ref_poses,
+    num_select,
+    angular_dist_method="vector",
+    scene_center=(0, 0, 0),
+):
+    """
+    precompute the nearest reference views of every target pose once per scene, so that selecting the source views of
+    a sample is a row lookup instead of a distance computation + argsort over the whole scene
+    :param tar_poses: target poses [M, 4, 4]
+    :param ref_poses: reference poses [N, 4, 4]
+    :param num_select: the number of nearest views kept for each target
+    :return: indices of the nearest reference views sorted by increasing distance [M, min(num_select, N)]
+    """
+    num_select = min(num_select, len(ref_poses))
+    dists = batched_pose_dists(tar_poses, ref_poses, angular_dist_method, scene_center)
+    return np.argsort(dists, axis=1, kind="stable")[:, :num_select]
+
+
+def load_nearest_pose_table(table_file, poses, num_select, angular_dist_method="vector"):
+    """
+    load the table written by a previous run if it was built from the same poses with enough neighbours, otherwise
+    build it and write it next to the scene. The poses of the scene are the targets and the references at the same time.
+    :return: [N, min(num_select, N)]
+    """
+    if os.path.exists(table_file):
+        'a corrupt or truncated file, e.g. written before the writes were atomic, is rebuilt'
+        try:
+            with np.load(table_file) as saved:
+                saved_poses, saved_table = saved["poses"], saved["table"]
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile) as e:
+            print("can not read the nearest pose table {} ({}), it is rebuilt".format(table_file, e))
+            saved_poses, saved_table = None, None
+        if (
+            saved_table is not None
+            and saved_table.ndim == 2
+            and saved_table.shape[0] == len(poses)
+            and np.array_equal(saved_poses, poses)
+            and saved_table.shape[1] >= min(num_select, len(poses))
+        ):
+            return saved_table[:, :num_select]
+
+    table = build_nearest_pose_table(poses, poses, num_select, angular_dist_method)
+    'every process (e.g. every DDP rank) writes its own temporary file, the complete file is published by os.replace'
+    tmp_file = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(table_file) or ".", prefix=os.path.basename(table_file) + ".", suffix=".tmp",
+            delete=False,
+        ) as f:
+            tmp_file = f.name
+            np.savez(f, table=table, poses=poses)
+        os.replace(tmp_file, table_file)
+    except OSError:
+        print("can not write {}, the nearest pose table is only kept in memory".format(table_file))
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return table
+
+
+def get_nearest_pose_ids_from_table(nearest_pose_table, row, num_select, tar_id=-1):
+    """
+    same selection as get_nearest_pose_ids(), read from a table built by build_nearest_pose_table()
+    :param row: the row of the target pose in the table
+    :param tar_id: if >= 0, this reference view is never selected
+    :return: the selected indices
+    """
+    num_select = min(num_select, nearest_pose_table.shape[1] - 1)
+    candidates = nearest_pose_table[row]
+    if tar_id >= 0:
+        candidates = candidates[candidates != tar_id]
+    return candidates[:num_select]
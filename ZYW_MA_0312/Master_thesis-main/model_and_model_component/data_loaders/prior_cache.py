@@ -0,0 +1,121 @@
+import os
+import json
+import numpy as np
+
+
+'''
+Binary cache for the per-image depth priors and sky masks of the nuscene dataset.
+The json files written by the depth / sky segmentation step are huge nested lists, parsing them with json.load + np.array
+dominates the time of NusceneDataset_train_val.__getitem__. The converter below writes each of them once as .npy next to
+the json file:
+    *_depth_value_pred.json -> *_depth_value_pred.npy, float16 [H, W]
+    *_sky_mask.json         -> *_sky_mask.npy, uint8 [H, ceil(W / 8)], the 0/1 mask packed along the width
+Both files are opened with mmap_mode="r", so only the pages that are actually read are touched.
+'''
+
+
+def depth_value_npy_path(depth_value_file):
+    return os.path.splitext(depth_value_file)[0] + ".npy"
+
+
+def sky_mask_npy_path(sky_mask_file):
+    return os.path.splitext(sky_mask_file)[0] + ".npy"
+
+
+def convert_depth_value_file(depth_value_file, overwrite=False):
+    npy_file = depth_value_npy_path(depth_value_file)
+    if os.path.exists(npy_file) and not overwrite:
+        return npy_file
+    with open(depth_value_file, 'r') as f:
+        depth_value_dictionary = json.load(f)
+    depth_value = np.array(depth_value_dictionary['depth_value_pred'], dtype=np.float32)
+    np.save(npy_file, depth_value.astype(np.float16))
+    return npy_file
+
+
+def convert_sky_mask_file(sky_mask_file, overwrite=False):
+    npy_file = sky_mask_npy_path(sky_mask_file)
+    if os.path.exists(npy_file) and not overwrite:
+        return npy_file
+    with open(sky_mask_file, 'r') as f:
+        sky_mask_dictionary = json.load(f)
+    sky_mask_0_1 = np.array(sky_mask_dictionary['sky_mask'])
+    if not np.isin(sky_mask_0_1, (0, 1)).all():
+        raise ValueError("sky mask {} is not a 0/1 mask and can not be bit-packed".format(sky_mask_file))
+    np.save(npy_file, np.packbits(sky_mask_0_1.astype(np.uint8), axis=-1))
+    return npy_file
+
+
+def load_depth_value(depth_value_file, use_binary_cache=False):
+    """
+    :param depth_value_file: path of the *_depth_value_pred.json file
+    :param use_binary_cache: if True, read the memory-mapped .npy written by convert_depth_value_file()
+    :return: depth value [H, W]. from the binary cache it is the np.float16 memmap itself, nothing is read yet: the
+    caller casts the part it uses, e.g. np.asarray(depth_value[rows], dtype=np.float32)
+    """
+    if use_binary_cache is False:
+        with open(depth_value_file, 'r') as f:
+            depth_value_dictionary = json.load(f)
+        return np.array(depth_value_dictionary['depth_value_pred'])
+
+    npy_file = depth_value_npy_path(depth_value_file)
+    if not os.path.exists(npy_file):
+        raise FileNotFoundError("{} does not exist, run prior_cache.py to convert the json priors first".format(npy_file))
+    return np.load(npy_file, mmap_mode="r")
+
+
+def load_sky_mask(sky_mask_file, width, use_binary_cache=False):
+    """
+    :param sky_mask_file: path of the *_sky_mask.json file
+    :param width: width of the image, needed to drop the padding bits of the packed mask
+    :param use_binary_cache: if True, read the memory-mapped .npy written by convert_sky_mask_file()
+    :return: sky mask, sky area = 0, other area = 1, np.int64 [H, W]
+    """
+    if use_binary_cache is False:
+        with open(sky_mask_file, 'r') as f:
+            sky_mask_dictionary = json.load(f)
+        return np.array(sky_mask_dictionary['sky_mask'])
+
+    npy_file = sky_mask_npy_path(sky_mask_file)
+    if not os.path.exists(npy_file):
+        raise FileNotFoundError("{} does not exist, run prior_cache.py to convert the json priors first".format(npy_file))
+    packed_sky_mask = np.load(npy_file, mmap_mode="r")
+    return np.unpackbits(packed_sky_mask, axis=-1, count=width).astype(np.int64)
+
+
+def convert_scene(scene_path, overwrite=False):
+    '''
+    convert the depth priors and sky masks of all images listed in images_info_dictionary_{train, val}.json of one scene
+    '''
+    for mode in ["train", "val"]:
+        pose_file = os.path.join(scene_path, "images_info_dictionary_{}.json".format(mode))
+        if not os.path.exists(pose_file):
+            continue
+        with open(pose_file, "r") as fp:
+            images_info_dictionary = json.load(fp)
+
+        for key in images_info_dictionary.keys():
+            convert_depth_value_file(
+                os.path.join(scene_path, 'depth_value_metric_v2', key + "_depth_value_pred.json"), overwrite=overwrite
+            )
+            convert_sky_mask_file(
+                os.path.join(scene_path, 'depth_sky_mask_v2', key + "_sky_mask.json"), overwrite=overwrite
+            )
+        print("converted {} {} images of {}".format(len(images_info_dictionary), mode, scene_path))
+
+
+def main():
+    import config
+
+    parser = config.config_parser()
+    parser.add_argument("--overwrite_prior_cache", action="store_true", help="rewrite existing .npy files")
+    args = parser.parse_args()
+
+    folder_path = os.path.join(args.rootdir, "data/Nuscene/")
+    scenes = sorted(set(list(args.train_scenes) + list(args.eval_scenes)))
+    for scene in scenes:
+        convert_scene(os.path.join(folder_path, scene), overwrite=args.overwrite_prior_cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import atexit
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedImageCache(object):
+    '''
+    LRU cache of decoded uint8 frames that is shared by all DataLoader workers.
+
+    Everything lives in one block of shared memory: the key, the last-used tick and the version of every slot, three
+    counters (clock, hits, misses) and the frames themselves. The block is created by the main process before the workers
+    are started, the workers attach to it by name, so a frame decoded by one worker can be read by all the others.
+
+    The lock only guards the header, the frames are copied outside of it. Like a seqlock, the version of a slot is odd
+    while its frame is written: a reader checks key and version again after its copy and treats a changed slot as a miss.
+    '''
+
+    def __init__(self, budget_bytes, frame_shape):
+        """
+        :param budget_bytes: maximal number of bytes used for the frames, the number of slots is budget_bytes // frame bytes
+        :param frame_shape: shape of a decoded frame, e.g. (900, 1600, 3). frames with another shape are not cached
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.frame_bytes = int(np.prod(self.frame_shape))
+        self.num_slots = max(int(budget_bytes // self.frame_bytes), 0)
+        self.budget_bytes = self.num_slots * self.frame_bytes
+
+        header_bytes = 8 * (3 * self.num_slots + 3)
+        self._shm = shared_memory.SharedMemory(create=True, size=header_bytes + self.budget_bytes)
+        self._name = self._shm.name
+        self._lock = mp.Lock()
+        self._owner = True
+        self._attach_views()
+
+        self._slot_keys[:] = -1
+        self._slot_ticks[:] = 0
+        self._slot_versions[:] = 0
+        self._counters[:] = 0
+
+        atexit.register(self.close)
+
+    def _attach_views(self):
+        n = self.num_slots
+        self._slot_keys = np.ndarray((n,), dtype=np.int64, buffer=self._shm.buf, offset=0)
+        self._slot_ticks = np.ndarray((n,), dtype=np.int64, buffer=self._shm.buf, offset=8 * n)
+        self._slot_versions = np.ndarray((n,), dtype=np.int64, buffer=self._shm.buf, offset=16 * n)
+        self._counters = np.ndarray((3,), dtype=np.int64, buffer=self._shm.buf, offset=24 * n)  # clock, hits, misses
+        self._frames = np.ndarray(
+            (n,) + self.frame_shape, dtype=np.uint8, buffer=self._shm.buf, offset=8 * (3 * n + 3)
+        )
+
+    def __getstate__(self):
+        'only used when the workers are spawned instead of forked, the shared memory is attached again by its name'
+        state = self.__dict__.copy()
+        for k in ["_shm", "_slot_keys", "_slot_ticks", "_slot_versions", "_counters", "_frames"]:
+            del state[k]
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=self._name)
+        try:
+            # the workers must not unlink the block when they exit, only the process that created it does
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        except Exception:
+            pass
+        self._attach_views()
+
+    def get(self, key, load_fn):
+        """
+        :param key: integer id of the frame, unique within the dataset
+        :param load_fn: function that decodes the frame, only called on a miss
+        :return: the decoded uint8 frame, a private copy that can be modified by the caller
+        """
+        with self._lock:
+            slots = np.flatnonzero(self._slot_keys == key)
+            if len(slots) > 0:
+                slot = slots[0]
+                version = int(self._slot_versions[slot])
+                self._counters[0] += 1
+                self._slot_ticks[slot] = self._counters[0]
+                self._counters[1] += 1
+            else:
+                slot = None
+                self._counters[2] += 1
+
+        if slot is not None:
+            frame = self._frames[slot].copy()
+            'the slot may have been evicted and rewritten during the copy'
+            if self._slot_keys[slot] == key and self._slot_versions[slot] == version:
+                return frame
+            'the frame is read from disk after all, count the lookup as a miss'
+            with self._lock:
+                self._counters[1] -= 1
+                self._counters[2] += 1
+
+        frame = load_fn()
+        if self.num_slots == 0 or frame.dtype != np.uint8 or frame.shape != self.frame_shape:
+            return frame
+
+        with self._lock:
+            'another worker may have decoded the same frame in the meantime, the slots being written are skipped'
+            writable = self._slot_versions % 2 == 0
+            if (self._slot_keys == key).any() or not writable.any():
+                return frame
+            # empty slots have tick 0 and are used first
+            slot = int(np.argmin(np.where(writable, self._slot_ticks, np.iinfo(np.int64).max)))
+            self._counters[0] += 1
+            self._slot_keys[slot] = -1
+            self._slot_ticks[slot] = self._counters[0]
+            self._slot_versions[slot] += 1
+
+        self._frames[slot] = frame
+
+        with self._lock:
+            self._slot_keys[slot] = key
+            self._slot_versions[slot] += 1
+        return frame
+
+    def stats(self):
+        with self._lock:
+            hits = int(self._counters[1])
+            misses = int(self._counters[2])
+            num_cached = int((self._slot_keys >= 0).sum())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(hits + misses, 1),
+            "cached_frames": num_cached,
+            "num_slots": self.num_slots,
+            "budget_MB": self.budget_bytes / 2 ** 20,
+        }
+
+    def close(self):
+        if self._shm is None:
+            return
+        self._slot_keys = self._slot_ticks = self._slot_versions = self._counters = self._frames = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
@@ -2,9 +2,148 @@ import torch
 import torch.nn.functional as F
 
 
+class ProjectionContext(object):
+    '''
+    per-view projection matrices and camera centres of one set of source cameras, computed once and reused by all
+    calls of Projector.compute() with the same source cameras, e.g. all chunks of render_single_image()
+    '''
+
+    def __init__(self, train_cameras):
+        """
+        :param train_cameras: [n_views, 34] or [1, n_views, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+        """
+        train_cameras = train_cameras.reshape(-1, train_cameras.shape[-1])
+        train_intrinsics = train_cameras[:, 2:18].reshape(-1, 4, 4)  # [n_views, 4, 4]
+        train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
+        self.num_views = len(train_cameras)
+        'source image intrinsics * inverse source image pose, only the first 3 rows are needed for the pixel coordinates'
+        self.projection_matrices = train_intrinsics.bmm(torch.inverse(train_poses))[:, :3, :]  # [n_views, 3, 4]
+        self.camera_centers = train_poses[:, :3, 3]  # [n_views, 3]
+        'the points are projected into all views with one [n_points, 3] x [3, n_views * 3] matmul'
+        self.rotation_t = self.projection_matrices[:, :, :3].reshape(-1, 3).t().contiguous()  # [3, n_views * 3]
+        self.translation = self.projection_matrices[:, :, 3].reshape(-1)  # [n_views * 3]
+
+    def project(self, xyz):
+        """
+        :param xyz: [n_points, 3]
+        :return: [n_views, n_points, 3], x * depth, y * depth, depth in every source camera
+        """
+        projections = torch.addmm(self.translation, xyz, self.rotation_t)  # [n_points, n_views * 3]
+        return projections.reshape(-1, self.num_views, 3).permute(1, 0, 2)
+
+
+texture_dtypes = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def select_top_k_views(rgb_feat_sampled, ray_diff, mask, k):
+    """
+    keep the k most relevant source views of every sample: the valid views (in bound and in front of the camera) with the
+    largest cosine between the query ray and the source ray, ray_diff[..., 3]. samples with less than k valid views keep
+    some invalid views, they stay masked out
+    :param rgb_feat_sampled: [n_rays, n_samples, n_views, 3+d]
+    :param ray_diff: [n_rays, n_samples, n_views, 4]
+    :param mask: [n_rays, n_samples, n_views, 1]
+    :return: rgb_feat_sampled, ray_diff, mask with n_views = k
+    """
+    score = ray_diff[..., 3].masked_fill(mask[..., 0] == 0, float("-inf"))
+    view_inds = torch.topk(score, k, dim=-1).indices  # [n_rays, n_samples, k]
+
+    def gather_views(x):
+        return torch.gather(x, 2, view_inds[..., None].expand(-1, -1, -1, x.shape[-1]))
+
+    return gather_views(rgb_feat_sampled), gather_views(ray_diff), gather_views(mask)
+
+
 class Projector:
-    def __init__(self, device):
+    def __init__(
+        self, device, fused_sampling=False, texture_dtype="float32", top_k_views=0, occlusion_test=False,
+        occlusion_tolerance=0.1,
+    ):
+        """
+        :param fused_sampling: if True and the feature maps have the resolution of the images, rgb and feature maps are
+        sampled from one pre-concatenated texture with a single grid_sample call, see get_sampling_texture()
+        :param texture_dtype: precision the fused texture is rounded to, float32 / float16 / bfloat16. it is kept in
+        float32 for the sampling, see get_sampling_texture()
+        :param top_k_views: if 0 < top_k_views < n_views, compute() only returns the top_k_views most relevant views of
+        every sample, see select_top_k_views()
+        :param occlusion_test: if True, compute() needs the depth maps of the source views and masks out the views in
+        which a sample is occluded, see occlusion_mask()
+        :param occlusion_tolerance: a sample is occluded if its depth is larger than (1 + occlusion_tolerance) times the
+        depth of the source view at its pixel
+        """
         self.device = device
+        self.top_k_views = top_k_views
+        self.occlusion_test = occlusion_test
+        self.occlusion_tolerance = occlusion_tolerance
+        self.fused_sampling = fused_sampling
+        if texture_dtype not in texture_dtypes:
+            raise Exception("texture_dtype {} is not supported, use one of {}".format(texture_dtype, list(texture_dtypes)))
+        self.texture_dtype = texture_dtypes[texture_dtype]
+        'the fused texture of the last source images / feature maps, only cached if no gradient flows into it'
+        self.texture_inputs = None
+        self.texture = None
+        self.warned_unfused = False
+        'the context of the last source cameras, see get_projection_context()'
+        self.context_cameras = None
+        self.context_cameras_version = None
+        self.context = None
+
+    def get_projection_context(self, train_cameras):
+        """
+        :param train_cameras: [n_views, 34] or [1, n_views, 34]
+        :return: ProjectionContext of train_cameras, rebuilt only if another tensor is passed or it was modified in place
+        """
+        if self.context_cameras is not train_cameras or self.context_cameras_version != train_cameras._version:
+            self.context = ProjectionContext(train_cameras)
+            'the reference keeps the tensor alive, so another source set can not reuse its memory'
+            self.context_cameras = train_cameras
+            self.context_cameras_version = train_cameras._version
+        return self.context
+
+    def get_sampling_texture(self, train_imgs, featmaps):
+        """
+        concatenate the source images and the feature maps into one channels-last texture [n_views, 3+d, h, w]. only
+        possible if the feature maps have the resolution of the images, they are never resampled: an upsampled texture
+        costs far more memory than the two grid_sample calls and changes the sampled features. the feature extractors
+        of the repo (ResUNet, FPN) downsample, with them compute() always takes the two grid_sample calls.
+
+        the texture is rounded to texture_dtype and kept in float32 for grid_sample, whose grid has the dtype of the
+        texture: a float16 / bfloat16 grid is off by pixels near the image border. it is reused as long as the same
+        tensors are passed and no gradient flows into the feature maps, e.g. for all chunks of render_single_image()
+        :param train_imgs: [1, n_views, h, w, 3], the tensor passed to compute()
+        :param featmaps: [n_views, d, h_feat, w_feat]
+        :return: float32 texture, None if the resolutions differ
+        """
+        if featmaps.shape[-2:] != train_imgs.shape[-3:-1]:
+            if not self.warned_unfused:
+                print(
+                    "fused_sampling: the feature maps ({}) do not have the resolution of the source images ({}), "
+                    "the images and the feature maps are sampled separately".format(
+                        tuple(featmaps.shape[-2:]), tuple(train_imgs.shape[-3:-1])
+                    )
+                )
+                self.warned_unfused = True
+            return None
+
+        inputs = (train_imgs, train_imgs._version, featmaps, featmaps._version)
+        if (
+            self.texture_inputs is not None
+            and all(a is b for a, b in zip(inputs[::2], self.texture_inputs[::2]))
+            and inputs[1::2] == self.texture_inputs[1::2]
+        ):
+            return self.texture
+
+        train_imgs = train_imgs.squeeze(0).permute(0, 3, 1, 2)  # [n_views, 3, h, w]
+        texture = torch.cat([train_imgs.to(featmaps.dtype), featmaps], dim=1).to(self.texture_dtype).float()
+        texture = texture.contiguous(memory_format=torch.channels_last)
+
+        if featmaps.requires_grad:
+            self.texture_inputs = None
+            self.texture = None
+        else:
+            self.texture_inputs = inputs
+            self.texture = texture
+        return texture
 
     def inbound(self, pixel_locations, h, w):
         """
@@ -28,53 +167,68 @@ class Projector:
         )  # [n_views, n_points, 2]
         return normalized_pixel_locations
 
-    def compute_projections(self, xyz, train_cameras):
+    def occlusion_mask(self, normalized_pixel_locations, depths, src_depths):
+        """
+        depth test of the samples against the depth maps of the source views. the depth maps are read with nearest
+        sampling, a bilinear read mixes foreground and background depth at the depth edges. pixels without a valid
+        depth do not occlude anything
+        :param normalized_pixel_locations: [n_views, n_rays, n_samples, 2]
+        :param depths: depth of the samples in the source cameras, [n_views, n_rays, n_samples]
+        :param src_depths: [n_views, h, w]
+        :return: mask, True if the sample is visible in the view, [n_views, n_rays, n_samples]
+        """
+        src_depth_sampled = F.grid_sample(
+            src_depths.unsqueeze(1).to(depths.dtype), normalized_pixel_locations, mode="nearest", align_corners=True
+        )[:, 0]  # [n_views, n_rays, n_samples]
+        valid_depth = torch.isfinite(src_depth_sampled) & (src_depth_sampled > 0)
+        return ~valid_depth | (depths <= src_depth_sampled * (1.0 + self.occlusion_tolerance))
+
+    def compute_projections(self, xyz, train_cameras, context=None, ret_depth=False):
         """
         project 3D points into cameras
         :param xyz: [..., 3]
         :param train_cameras: [n_views, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
+        :param context: optional ProjectionContext of train_cameras
+        :param ret_depth: if True, the depth of the points in the cameras [n_views, ...] is returned as well
         :return: pixel locations [..., 2], mask [...]
         """
         original_shape = xyz.shape[:2]
         xyz = xyz.reshape(-1, 3)
         num_views = len(train_cameras)
-        train_intrinsics = train_cameras[:, 2:18].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        'LinGaoyuan_20240919: h is homo'
-        xyz_h = torch.cat([xyz, torch.ones_like(xyz[..., :1])], dim=-1)  # [n_points, 4]
+        if context is None:
+            context = self.get_projection_context(train_cameras)
         'LinGaoyuan_20240919: source image intrinsics * source image pose * 3D sampled points = 2D sampled points coordination in each source image ebene'
-        projections = train_intrinsics.bmm(torch.inverse(train_poses)).bmm(
-            xyz_h.t()[None, ...].repeat(num_views, 1, 1)
-        )  # [n_views, 4, n_points]
-        projections = projections.permute(0, 2, 1)  # [n_views, n_points, 4]
+        projections = context.project(xyz)  # [n_views, n_points, 3]
         'LinGaoyuan_20240919: x,y coordinate / z coordinate(depth)'
         pixel_locations = projections[..., :2] / torch.clamp(
             projections[..., 2:3], min=1e-8
         )  # [n_views, n_points, 2]
         pixel_locations = torch.clamp(pixel_locations, min=-1e6, max=1e6)
         mask = projections[..., 2] > 0  # a point is invalid if behind the camera
-        return pixel_locations.reshape((num_views,) + original_shape + (2,)), mask.reshape(
-            (num_views,) + original_shape
-        )
+        pixel_locations = pixel_locations.reshape((num_views,) + original_shape + (2,))
+        mask = mask.reshape((num_views,) + original_shape)
+        if ret_depth:
+            return pixel_locations, mask, projections[..., 2].reshape((num_views,) + original_shape)
+        return pixel_locations, mask
 
-    def compute_angle(self, xyz, query_camera, train_cameras):
+    def compute_angle(self, xyz, query_camera, train_cameras, context=None):
         """
         :param xyz: [..., 3]
         :param query_camera: [34, ]
         :param train_cameras: [n_views, 34]
+        :param context: optional ProjectionContext of train_cameras
         :return: [n_views, ..., 4]; The first 3 channels are unit-length vector of the difference between
         query and target ray directions, the last channel is the inner product of the two directions.
         """
         original_shape = xyz.shape[:2]
         xyz = xyz.reshape(-1, 3)
-        train_poses = train_cameras[:, -16:].reshape(-1, 4, 4)  # [n_views, 4, 4]
-        num_views = len(train_poses)
-        query_pose = (
-            query_camera[-16:].reshape(-1, 4, 4).repeat(num_views, 1, 1)
-        )  # [n_views, 4, 4]
-        ray2tar_pose = query_pose[:, :3, 3].unsqueeze(1) - xyz.unsqueeze(0)
-        ray2tar_pose /= torch.norm(ray2tar_pose, dim=-1, keepdim=True) + 1e-6
-        ray2train_pose = train_poses[:, :3, 3].unsqueeze(1) - xyz.unsqueeze(0)
+        if context is None:
+            context = self.get_projection_context(train_cameras)
+        num_views = context.num_views
+        'the direction to the query camera is the same for all views'
+        ray2tar_pose = query_camera[-16:].reshape(4, 4)[:3, 3].unsqueeze(0) - xyz  # [n_points, 3]
+        ray2tar_pose = (ray2tar_pose / (torch.norm(ray2tar_pose, dim=-1, keepdim=True) + 1e-6)).unsqueeze(0)
+        ray2train_pose = context.camera_centers.unsqueeze(1) - xyz.unsqueeze(0)
         ray2train_pose /= torch.norm(ray2train_pose, dim=-1, keepdim=True) + 1e-6
         ray_diff = ray2tar_pose - ray2train_pose
         ray_diff_norm = torch.norm(ray_diff, dim=-1, keepdim=True)
@@ -84,13 +238,14 @@ class Projector:
         ray_diff = ray_diff.reshape((num_views,) + original_shape + (4,))
         return ray_diff
 
-    def compute(self, xyz, query_camera, train_imgs, train_cameras, featmaps):
+    def compute(self, xyz, query_camera, train_imgs, train_cameras, featmaps, src_depths=None):
         """
         :param xyz: [n_rays, n_samples, 3]
         :param query_camera: [1, 34], 34 = img_size(2) + intrinsics(16) + extrinsics(16)
         :param train_imgs: [1, n_views, h, w, 3]
         :param train_cameras: [1, n_views, 34]
         :param featmaps: [n_views, d, h, w]
+        :param src_depths: depth maps of the source views [1, n_views, h, w], needed by the occlusion test
         :return: rgb_feat_sampled: [n_rays, n_samples, 3+n_feat],
                  ray_diff: [n_rays, n_samples, 4],
                  mask: [n_rays, n_samples, 1]
@@ -100,6 +255,12 @@ class Projector:
             and (train_cameras.shape[0] == 1)
             and (query_camera.shape[0] == 1)
         ), "only support batch_size=1 for now"
+        if self.occlusion_test and src_depths is None:
+            raise Exception("the occlusion test needs the depth maps of the source views!")
+
+        'the context and the texture are looked up with the tensors of the caller, the views below are new in every call'
+        context = self.get_projection_context(train_cameras)
+        texture = self.get_sampling_texture(train_imgs, featmaps) if self.fused_sampling else None
 
         train_imgs = train_imgs.squeeze(0)  # [n_views, h, w, 3]
         train_cameras = train_cameras.squeeze(0)  # [n_views, 34]
@@ -110,27 +271,49 @@ class Projector:
         h, w = train_cameras[0][:2]
 
         # compute the projection of the query points to each reference image
-        pixel_locations, mask_in_front = self.compute_projections(xyz, train_cameras)
+        pixel_locations, mask_in_front, depths = self.compute_projections(
+            xyz, train_cameras, context=context, ret_depth=True
+        )
         normalized_pixel_locations = self.normalize(
             pixel_locations, h, w
         )  # [n_views, n_rays, n_samples, 2]
 
-        # rgb sampling
-        rgbs_sampled = F.grid_sample(train_imgs, normalized_pixel_locations, align_corners=True)
-        rgb_sampled = rgbs_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, 3]
+        'the occluded views of a sample are masked out like the views that do not see it at all'
+        if self.occlusion_test:
+            mask_in_front = mask_in_front & self.occlusion_mask(
+                normalized_pixel_locations, depths, src_depths.squeeze(0)
+            )
 
-        # deep feature sampling
-        feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
-        feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
-        rgb_feat_sampled = torch.cat(
-            [rgb_sampled, feat_sampled], dim=-1
-        )  # [n_rays, n_samples, n_views, d+3]
+        if texture is not None:
+            '''
+            one grid_sample on the fused texture instead of two, the cat of the two results is saved. the permuted view
+            is passed on as it is, the view transformers copy it when they need a contiguous layout
+            '''
+            rgb_feat_sampled = F.grid_sample(
+                texture, normalized_pixel_locations, align_corners=True
+            )  # [n_views, d+3, n_rays, n_samples]
+            rgb_feat_sampled = rgb_feat_sampled.permute(2, 3, 0, 1).to(featmaps.dtype)  # [n_rays, n_samples, n_views, d+3]
+        else:
+            # rgb sampling
+            rgbs_sampled = F.grid_sample(train_imgs, normalized_pixel_locations, align_corners=True)
+            rgb_sampled = rgbs_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, 3]
+
+            # deep feature sampling
+            feat_sampled = F.grid_sample(featmaps, normalized_pixel_locations, align_corners=True)
+            feat_sampled = feat_sampled.permute(2, 3, 0, 1)  # [n_rays, n_samples, n_views, d]
+            rgb_feat_sampled = torch.cat(
+                [rgb_sampled, feat_sampled], dim=-1
+            )  # [n_rays, n_samples, n_views, d+3]
 
         # mask
         inbound = self.inbound(pixel_locations, h, w)
-        ray_diff = self.compute_angle(xyz, query_camera, train_cameras)
+        ray_diff = self.compute_angle(xyz, query_camera, train_cameras, context=context)
         ray_diff = ray_diff.permute(1, 2, 0, 3)
         mask = (
             (inbound * mask_in_front).float().permute(1, 2, 0)[..., None]
         )  # [n_rays, n_samples, n_views, 1]
+
+        'the view transformers only attend over the selected views'
+        if 0 < self.top_k_views < mask.shape[2]:
+            rgb_feat_sampled, ray_diff, mask = select_top_k_views(rgb_feat_sampled, ray_diff, mask, self.top_k_views)
         return rgb_feat_sampled, ray_diff, mask
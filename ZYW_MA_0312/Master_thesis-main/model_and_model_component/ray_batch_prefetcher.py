@@ -0,0 +1,94 @@
+import queue
+import threading
+
+import torch
+
+
+class RayBatchPrefetcher(object):
+    '''
+    iterate over the train loader and build the ray batch of the next steps on a side thread, while the main thread runs
+    the current training step.
+
+    The host to device copies of the side thread are issued on a separate CUDA stream, the main thread waits on an event
+    of that stream only when it takes the batch, so the GPU does not wait for the ray generation.
+
+    prepare_fn runs concurrently with the training step, it must not read state that the training step writes (e.g. the
+    PixelErrorMap of sample_mode "importance") or draw from the global random generators, pass it its own generators.
+    '''
+
+    def __init__(self, loader, prepare_fn, device, num_prefetch=2):
+        """
+        :param loader: train loader, yields train_data
+        :param prepare_fn: function train_data -> (ray_sampler, ray_batch), e.g. RaySamplerSingleImage + random_sample()
+        :param device: device of the ray batch
+        :param num_prefetch: number of ray batches prepared in advance
+        """
+        self.loader = loader
+        self.prepare_fn = prepare_fn
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+
+        self.queue = queue.Queue(maxsize=max(int(num_prefetch), 1))
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        'block until there is space in the queue, unless the prefetcher is closed'
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self):
+        try:
+            if self.stream is not None and self.device.index is not None:
+                torch.cuda.set_device(self.device)
+            for train_data in self.loader:
+                if self.stop_event.is_set():
+                    return
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        ray_sampler, ray_batch = self.prepare_fn(train_data)
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    ray_sampler, ray_batch = self.prepare_fn(train_data)
+                    event = None
+                self._put((train_data, ray_sampler, ray_batch, event))
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            train_data, ray_sampler, ray_batch, event = item
+            if event is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                '''
+                the tensors of the ray batch and the ones the ray sampler holds (resized images, cameras, cached
+                directions, ...) were allocated on the side stream, tell the caching allocator that they are used here
+                '''
+                for value in list(ray_batch.values()) + list(vars(ray_sampler).values()):
+                    if torch.is_tensor(value) and value.is_cuda:
+                        value.record_stream(current_stream)
+            yield train_data, ray_sampler, ray_batch
+
+    def close(self):
+        self.stop_event.set()
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.thread.join(timeout=10)
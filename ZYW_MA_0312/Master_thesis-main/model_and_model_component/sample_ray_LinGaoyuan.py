@@ -2,6 +2,9 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+from LinGaoyuan_function.image_resize import resize_img_batched
+from model_and_model_component.data_loaders.data_utils import resize_camera
+
 
 rng = np.random.RandomState(234)
 
@@ -18,6 +21,112 @@ def parse_camera(params):
     return W, H, intrinsics, c2w
 
 
+'''
+camera-space directions K^-1 [u, v, 1] of all pixels, keyed by (intrinsics, H, W, render_stride, device). nuScenes has only
+a few fixed intrinsics, so the rays of an image are one rotation of a cached table
+'''
+camera_direction_cache = {}
+max_camera_direction_cache_size = 16
+
+
+def get_camera_directions(intrinsics, H, W, render_stride, device):
+    """
+    :param intrinsics: 4 by 4 intrinsic matrix
+    :return: camera-space direction of every (strided) pixel, [H * W, 3] on device, row-major like the pixel indices
+    """
+    key = (tuple(intrinsics[:3, :3].flatten().tolist()), H, W, render_stride, str(device))
+    if key not in camera_direction_cache:
+        if len(camera_direction_cache) >= max_camera_direction_cache_size:
+            camera_direction_cache.pop(next(iter(camera_direction_cache)))
+        v, u = torch.meshgrid(
+            torch.arange(H)[::render_stride].float(), torch.arange(W)[::render_stride].float(), indexing="ij"
+        )
+        pixels = torch.stack((u.reshape(-1), v.reshape(-1), torch.ones_like(u.reshape(-1))), dim=0)  # (3, H*W)
+        directions = torch.inverse(intrinsics[:3, :3].float()).mm(pixels).t()
+        camera_direction_cache[key] = directions.to(device).contiguous()
+    return camera_direction_cache[key]
+
+
+center_pixel_inds_cache = {}
+
+
+def get_center_pixel_inds(H, W, center_ratio, device):
+    """
+    :return: flat indices of the pixels in the center crop, [N] long tensor on device, the pool of the "center" sample mode
+    """
+    key = (H, W, center_ratio, str(device))
+    if key not in center_pixel_inds_cache:
+        border_H = int(H * (1 - center_ratio) / 2.0)
+        border_W = int(W * (1 - center_ratio) / 2.0)
+        rows = torch.arange(border_H, H - border_H)
+        cols = torch.arange(border_W, W - border_W)
+        center_pixel_inds_cache[key] = (rows[:, None] * W + cols[None, :]).reshape(-1).to(device)
+    return center_pixel_inds_cache[key]
+
+
+class PixelErrorMap(object):
+    '''
+    low-resolution per-image map of the rgb error, used by the "importance" sample mode.
+
+    Every image is divided into cells of cell_size x cell_size pixels. A cell is drawn with probability
+        q = (1 - uniform_floor) * error / sum(error) + uniform_floor * pixels in cell / (H * W)
+    and a pixel is drawn uniformly inside the cell. The cells are drawn with replacement, so the sample weight
+    1 / (H * W * p(pixel)) makes the weighted mean of the per-ray loss an unbiased estimate of the image loss.
+    '''
+
+    def __init__(self, num_images, H, W, cell_size=16, uniform_floor=0.2, momentum=0.1, device="cuda"):
+        self.H, self.W = int(H), int(W)
+        self.cell_size = int(cell_size)
+        self.uniform_floor = uniform_floor
+        self.momentum = momentum
+        self.grid_H = (self.H + self.cell_size - 1) // self.cell_size
+        self.grid_W = (self.W + self.cell_size - 1) // self.cell_size
+
+        'all cells start with the same error, the first samples of an image are uniform'
+        self.error = torch.ones((int(num_images), self.grid_H * self.grid_W), device=device)
+
+        cell_heights = (self.H - torch.arange(self.grid_H, device=device) * self.cell_size).clamp(max=self.cell_size)
+        cell_widths = (self.W - torch.arange(self.grid_W, device=device) * self.cell_size).clamp(max=self.cell_size)
+        self.cell_heights = cell_heights[:, None].expand(-1, self.grid_W).reshape(-1)
+        self.cell_widths = cell_widths[None, :].expand(self.grid_H, -1).reshape(-1)
+        self.cell_pixel_counts = (self.cell_heights * self.cell_widths).float()
+
+    def sample(self, idx, N_rand):
+        """
+        :param idx: index of the image
+        :return: select_inds, flat pixel indices [N_rand]; sample_weights, [N_rand] with expectation 1
+        """
+        error = self.error[int(idx)] + 1e-8
+        cell_prob = (1 - self.uniform_floor) * error / error.sum() + \
+                    self.uniform_floor * self.cell_pixel_counts / (self.H * self.W)
+        cells = torch.multinomial(cell_prob, N_rand, replacement=True)
+
+        rows = (cells // self.grid_W) * self.cell_size + \
+               (torch.rand(N_rand, device=cells.device) * self.cell_heights[cells]).long()
+        cols = (cells % self.grid_W) * self.cell_size + \
+               (torch.rand(N_rand, device=cells.device) * self.cell_widths[cells]).long()
+        select_inds = rows * self.W + cols
+
+        sample_weights = self.cell_pixel_counts[cells] / (self.H * self.W * cell_prob[cells])
+        return select_inds, sample_weights
+
+    def update(self, idx, select_inds, per_ray_error):
+        """
+        blend the mean error of the rays of every cell into the map
+        :param select_inds: flat pixel indices of the rays, [N]
+        :param per_ray_error: error of every ray, [N]
+        """
+        select_inds = torch.as_tensor(select_inds, device=self.error.device).long()
+        cells = (select_inds // self.W) // self.cell_size * self.grid_W + (select_inds % self.W) // self.cell_size
+
+        error_sum = torch.zeros_like(self.error[0]).index_add_(0, cells, per_ray_error.detach().float().reshape(-1))
+        count = torch.zeros_like(self.error[0]).index_add_(0, cells, torch.ones_like(error_sum[cells]))
+        seen = count > 0
+
+        error = self.error[int(idx)]
+        error[seen] = (1 - self.momentum) * error[seen] + self.momentum * error_sum[seen] / count[seen]
+
+
 def dilate_img(img, kernel_size=20):
     import cv2
 
@@ -36,11 +145,6 @@ class RaySamplerSingleImage(object):
         self.rgb_path = data["rgb_path"]
         self.depth_range = data["depth_range"]
         self.device = device
-        W, H, self.intrinsics, self.c2w_mat = parse_camera(self.camera)
-        self.batch_size = len(self.camera)
-
-        self.H = int(H[0])
-        self.W = int(W[0])
 
         self.sky_mask = data["sky_mask"] if "sky_mask" in data.keys() else None
 
@@ -48,6 +152,25 @@ class RaySamplerSingleImage(object):
 
         self.idx = data["idx"] if "idx" in data.keys() else None
 
+        self.src_rgbs = data["src_rgbs"] if "src_rgbs" in data.keys() else None
+        self.src_cameras = data["src_cameras"] if "src_cameras" in data.keys() else None
+        self.src_sky_masks = data["src_sky_masks"] if "src_sky_masks" in data.keys() else None
+        self.src_depth_values = data["src_depth_values"] if "src_depth_values" in data.keys() else None
+
+        '''
+        uint8 images from the DataLoader (args.uint8_images) are normalized on the GPU. If the dataset deferred the resize
+        (args.uint8_images or args.gpu_resize), images, sky masks and depth values of target and source views are resized
+        together in one batched call and the intrinsics of camera and src_cameras are scaled accordingly.
+        '''
+        if self.rgb is not None and (self.rgb.dtype == torch.uint8 or "gpu_resize_hw" in data.keys()):
+            self.prepare_images_on_device(data["gpu_resize_hw"] if "gpu_resize_hw" in data.keys() else None)
+
+        W, H, self.intrinsics, self.c2w_mat = parse_camera(self.camera)
+        self.batch_size = len(self.camera)
+
+        self.H = int(H[0])
+        self.W = int(W[0])
+
         # half-resolution output
         if resize_factor != 1:
             self.W = int(self.W * resize_factor)
@@ -58,9 +181,11 @@ class RaySamplerSingleImage(object):
                     self.rgb.permute(0, 3, 1, 2), scale_factor=resize_factor
                 ).permute(0, 2, 3, 1)
 
-        self.rays_o, self.rays_d = self.get_rays_single_image(
-            self.H, self.W, self.intrinsics, self.c2w_mat
-        )
+        'the rays are only materialized when needed, see get_rays()'
+        self.camera_directions = torch.stack(
+            [get_camera_directions(K, self.H, self.W, self.render_stride, self.device) for K in self.intrinsics], dim=0
+        )  # [B, H*W, 3]
+        self._rays_o, self._rays_d = None, None
         if self.rgb is not None:
             self.rgb = self.rgb.reshape(-1, 3)
 
@@ -71,47 +196,90 @@ class RaySamplerSingleImage(object):
         if self.depth_value is not None:
             self.depth_value = self.depth_value.reshape(-1,1)
 
-        if "src_rgbs" in data.keys():
-            self.src_rgbs = data["src_rgbs"]
-        else:
-            self.src_rgbs = None
-        if "src_cameras" in data.keys():
-            self.src_cameras = data["src_cameras"]
-        else:
-            self.src_cameras = None
-
-        if "src_sky_masks" in data.keys():
-            self.src_sky_masks = data["src_sky_masks"]
-        else:
-            self.src_sky_masks = None
-
-    def get_rays_single_image(self, H, W, intrinsics, c2w):
+    def prepare_images_on_device(self, resize_hw=None):
         """
-        :param H: image height
-        :param W: image width
-        :param intrinsics: 4 by 4 intrinsic matrix
-        :param c2w: 4 by 4 camera to world extrinsic matrix
-        :return:
+        move rgb / src_rgbs to self.device (converting uint8 to float in [0, 1]) and optionally resize them together with
+        sky_mask / src_sky_masks / depth_value / src_depth_values in a single F.interpolate call
+        :param resize_hw: optional output size [B, 2], the same for all images
         """
-        u, v = np.meshgrid(
-            np.arange(W)[:: self.render_stride], np.arange(H)[:: self.render_stride]
-        )
-        u = u.reshape(-1).astype(dtype=np.float32)  # + 0.5    # add half pixel
-        v = v.reshape(-1).astype(dtype=np.float32)  # + 0.5
-        pixels = np.stack((u, v, np.ones_like(u)), axis=0)  # (3, H*W)
-        pixels = torch.from_numpy(pixels)
-        batched_pixels = pixels.unsqueeze(0).repeat(self.batch_size, 1, 1)
-
-        rays_d = (
-            c2w[:, :3, :3].bmm(torch.inverse(intrinsics[:, :3, :3])).bmm(batched_pixels)
-        ).transpose(1, 2)
-        rays_d = rays_d.reshape(-1, 3)  # shape: ([1440000, 3])
-        rays_o = (
-            c2w[:, :3, 3].unsqueeze(1).repeat(1, rays_d.shape[0], 1).reshape(-1, 3)
-        )  # B x HW x 3
-
+        B, H, W = self.rgb.shape[:3]
+        images = self.rgb.to(self.device, non_blocking=True).reshape(-1, H, W, 3)
+        if self.src_rgbs is not None:
+            images = torch.cat(
+                (images, self.src_rgbs.to(self.device, non_blocking=True).reshape(-1, H, W, 3)), dim=0
+            )  # [B * (1 + n_views), H, W, 3]
+        images = images.permute(0, 3, 1, 2)
+        images = images.float() / 255.0 if images.dtype == torch.uint8 else images.float()
+
+        if resize_hw is not None:
+            # the sky mask and the depth value are stacked as two extra channels, so that all maps are resized at once
+            maps = [(self.sky_mask, self.src_sky_masks), (self.depth_value, self.src_depth_values)]
+            for tar_map, src_maps in maps:
+                channel = tar_map.to(self.device, non_blocking=True).reshape(-1, 1, H, W)
+                if self.src_rgbs is not None:
+                    channel = torch.cat(
+                        (channel, src_maps.to(self.device, non_blocking=True).reshape(-1, 1, H, W)), dim=0
+                    )
+                images = torch.cat((images, channel.float()), dim=1)  # [B * (1 + n_views), 3 + 2, H, W]
+
+            new_H, new_W = int(resize_hw[0, 0]), int(resize_hw[0, 1])
+            images = resize_img_batched(images, new_H, new_W)
+
+            sky_masks = images[:, 3].round().to(self.sky_mask.dtype)
+            'the depth values of the binary prior cache arrive as float16, they are kept in float32 from here on'
+            depth_dtype = torch.float32 if self.depth_value.dtype == torch.float16 else self.depth_value.dtype
+            depth_values = images[:, 4].to(depth_dtype)
+            images = images[:, :3]
+
+            self.sky_mask = sky_masks[:B]
+            self.depth_value = depth_values[:B]
+            if self.src_rgbs is not None:
+                self.src_sky_masks = sky_masks[B:].reshape(B, -1, new_H, new_W)
+                self.src_depth_values = depth_values[B:].reshape(B, -1, new_H, new_W)
+
+            'the pixel coordinates shrink with the image: scale the first two rows of the intrinsics and update the image size'
+            self.camera = resize_camera(self.camera, new_H, new_W)
+            if self.src_cameras is not None:
+                self.src_cameras = resize_camera(self.src_cameras, new_H, new_W)
+            H, W = new_H, new_W
+
+        images = images.permute(0, 2, 3, 1).contiguous()
+        self.rgb = images[:B].reshape(B, H, W, 3)
+        if self.src_rgbs is not None:
+            self.src_rgbs = images[B:].reshape(B, -1, H, W, 3)
+
+    def get_rays(self, select_inds=None):
+        """
+        rotate the cached camera-space directions into the world frame
+        :param select_inds: optional flat pixel indices, only the rays of these pixels are computed
+        :return: rays_o, rays_d, [N, 3] on self.device, all B * H * W rays if select_inds is None
+        """
+        num_pixels = self.camera_directions.shape[1]
+        c2w = self.c2w_mat.to(self.camera_directions.device)
+        rotation, translation = c2w[:, :3, :3], c2w[:, :3, 3]
+        if select_inds is None:
+            rays_d = self.camera_directions.bmm(rotation.transpose(1, 2)).reshape(-1, 3)  # shape: ([1440000, 3])
+            rays_o = translation.unsqueeze(1).expand(-1, num_pixels, -1).reshape(-1, 3)  # B x HW x 3
+            return rays_o, rays_d
+
+        select_inds = torch.as_tensor(select_inds, device=self.camera_directions.device).long()
+        batch_inds, pixel_inds = select_inds // num_pixels, select_inds % num_pixels
+        rays_d = torch.einsum("nij,nj->ni", rotation[batch_inds], self.camera_directions[batch_inds, pixel_inds])
+        rays_o = translation[batch_inds]
         return rays_o, rays_d
 
+    @property
+    def rays_o(self):
+        if self._rays_o is None:
+            self._rays_o, self._rays_d = self.get_rays()
+        return self._rays_o
+
+    @property
+    def rays_d(self):
+        if self._rays_d is None:
+            self._rays_o, self._rays_d = self.get_rays()
+        return self._rays_d
+
     def get_all(self):
         ret = {
             "ray_o": self.rays_o.cuda(),
@@ -124,11 +292,35 @@ class RaySamplerSingleImage(object):
             "src_cameras": self.src_cameras.cuda() if self.src_cameras is not None else None,
             "sky_mask": self.sky_mask.cuda() if self.sky_mask is not None else None,
             "src_sky_mask": self.src_sky_masks.cuda() if self.src_sky_masks is not None else None,
+            "src_depth_values": self.src_depth_values.cuda() if self.src_depth_values is not None else None,
             "idx": self.idx.cuda() if self.idx is not None else None,
         }
         return ret
 
-    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8):
+    def sample_random_pixel(self, N_rand, sample_mode, center_ratio=0.8, on_device=False, error_map=None, np_rng=None,
+                            generator=None):
+        '''
+        with on_device=True the pixels are drawn without replacement by a randperm slice on self.device and returned as a
+        long tensor on self.device, instead of a np.ndarray drawn by rng.choice on the cpu
+        np_rng / generator: optional numpy / torch generators used instead of the global ones, see random_sample()
+        '''
+        if np_rng is None:
+            np_rng = rng
+        if sample_mode == "importance":
+            if error_map is None:
+                raise Exception("sample mode importance needs an error map!")
+            return error_map.sample(self.idx, N_rand)
+
+        if on_device is True:
+            if sample_mode == "center":
+                pixel_inds = get_center_pixel_inds(self.H, self.W, center_ratio, self.device)
+                select_inds = pixel_inds[torch.randperm(len(pixel_inds), device=self.device, generator=generator)[:N_rand]]
+            elif sample_mode == "uniform":
+                select_inds = torch.randperm(self.H * self.W, device=self.device, generator=generator)[:N_rand]
+            else:
+                raise Exception("unknown sample mode!")
+            return select_inds
+
         if sample_mode == "center":
             border_H = int(self.H * (1 - center_ratio) / 2.0)
             border_W = int(self.W * (1 - center_ratio) / 2.0)
@@ -140,59 +332,148 @@ class RaySamplerSingleImage(object):
             u = u.reshape(-1)
             v = v.reshape(-1)
 
-            select_inds = rng.choice(u.shape[0], size=(N_rand,), replace=False)
+            select_inds = np_rng.choice(u.shape[0], size=(N_rand,), replace=False)
             select_inds = v[select_inds] + self.W * u[select_inds]
 
         elif sample_mode == "uniform":
             # Random from one image
-            select_inds = rng.choice(self.H * self.W, size=(N_rand,), replace=False)
+            select_inds = np_rng.choice(self.H * self.W, size=(N_rand,), replace=False)
         else:
             raise Exception("unknown sample mode!")
 
         return select_inds
 
-    def random_sample(self, N_rand, sample_mode, center_ratio=0.8):
+    def sample_sky_stratified_pixel(self, N_rand, sky_ray_fraction, on_device=False, generator=None):
+        """
+        draw round(N_rand * sky_ray_fraction) pixels from the sky area and the rest from the other area, if one of the
+        areas is too small the other one fills up
+        :return: select_inds, the non-sky pixels first; num_nerf_rays, the number of non-sky pixels
+        """
+        device = self.device if on_device is True else "cpu"
+        is_sky = (self.sky_mask.reshape(-1) == 0).to(device)  # sky area = 0, other area = 1
+        sky_inds = torch.nonzero(is_sky).reshape(-1)
+        other_inds = torch.nonzero(~is_sky).reshape(-1)
+
+        N_sky = min(int(round(N_rand * sky_ray_fraction)), len(sky_inds))
+        num_nerf_rays = min(N_rand - N_sky, len(other_inds))
+        N_sky = min(N_rand - num_nerf_rays, len(sky_inds))
+
+        select_inds = torch.cat(
+            (
+                other_inds[torch.randperm(len(other_inds), device=device, generator=generator)[:num_nerf_rays]],
+                sky_inds[torch.randperm(len(sky_inds), device=device, generator=generator)[:N_sky]],
+            )
+        )
+        if on_device is False:
+            select_inds = select_inds.numpy()
+        return select_inds, num_nerf_rays
+
+    def sample_patch_pixel(self, N_rand, patch_size, patch_dilation=1, on_device=False, generator=None):
+        """
+        draw N_rand // patch_size**2 random patches of patch_size x patch_size pixels, the pixels of a patch are
+        patch_dilation pixels apart
+        :return: select_inds, [K * S * S] patch by patch in row-major order, i.e. reshape(K, S, S) gives the patches;
+        patch_shape, (K, S, S)
+        """
+        device = self.device if on_device is True else "cpu"
+        num_patches = max(N_rand // (patch_size * patch_size), 1)
+        extent = (patch_size - 1) * patch_dilation + 1
+        if extent > self.H or extent > self.W:
+            raise Exception("patch of {} pixels does not fit into the {}x{} image!".format(extent, self.H, self.W))
+
+        top = torch.randint(0, self.H - extent + 1, (num_patches, 1, 1), device=device, generator=generator)
+        left = torch.randint(0, self.W - extent + 1, (num_patches, 1, 1), device=device, generator=generator)
+        offsets = torch.arange(patch_size, device=device) * patch_dilation
+        rows = top + offsets[None, :, None]  # [K, S, 1]
+        cols = left + offsets[None, None, :]  # [K, 1, S]
+        select_inds = (rows * self.W + cols).reshape(-1)
+        if on_device is False:
+            select_inds = select_inds.numpy()
+        return select_inds, (num_patches, patch_size, patch_size)
+
+    def random_sample(self, N_rand, sample_mode, center_ratio=0.8, on_device=False, error_map=None, sky_ray_fraction=0.1,
+                      patch_size=16, patch_dilation=1, np_rng=None, generator=None):
         """
         :param N_rand: number of rays to be casted
+        :param on_device: draw the pixels on self.device, ret["selected_inds"] is then a tensor on self.device
+        :param error_map: PixelErrorMap of the train dataset, needed by sample_mode "importance"
+        :param sky_ray_fraction: fraction of sky-only rays of sample_mode "sky_stratified"
+        :param patch_size: side length of the patches of sample_mode "patch", N_rand // patch_size**2 patches are drawn
+        :param patch_dilation: distance in pixels between neighbouring pixels of a patch
+        :param np_rng: optional np.random.Generator for the pixels drawn on the cpu, default the global rng
+        :param generator: optional torch.Generator for the pixels drawn with torch, on the device the pixels are drawn on
+        (self.device if on_device else the cpu), default the global torch generator. a side thread that builds ray
+        batches passes its own generators, see RayBatchPrefetcher
         :return:
         """
 
-        select_inds = self.sample_random_pixel(N_rand, sample_mode, center_ratio)
+        sample_weights = None
+        num_nerf_rays = None
+        patch_shape = None
+        if sample_mode == "patch":
+            select_inds, patch_shape = self.sample_patch_pixel(
+                N_rand, patch_size, patch_dilation, on_device, generator=generator
+            )
+        elif sample_mode == "sky_stratified":
+            select_inds, num_nerf_rays = self.sample_sky_stratified_pixel(
+                N_rand, sky_ray_fraction, on_device, generator=generator
+            )
+        elif sample_mode == "importance":
+            select_inds, sample_weights = self.sample_random_pixel(
+                N_rand, sample_mode, center_ratio, on_device, error_map
+            )
+        else:
+            select_inds = self.sample_random_pixel(
+                N_rand, sample_mode, center_ratio, on_device, np_rng=np_rng, generator=generator
+            )
 
-        rays_o = self.rays_o[select_inds]
-        rays_d = self.rays_d[select_inds]
+        rays_o, rays_d = self.get_rays(select_inds)
 
         if self.rgb is not None:
-            rgb = self.rgb[select_inds]
+            rgb = self.gather_pixels(self.rgb, select_inds)
         else:
             rgb = None
 
         if self.sky_mask is not None:
-            sky_mask = self.sky_mask[select_inds]
+            sky_mask = self.gather_pixels(self.sky_mask, select_inds)
         else:
             sky_mask = None
 
         if self.depth_value is not None:
-            depth_value = self.depth_value[select_inds]
+            depth_value = self.gather_pixels(self.depth_value, select_inds)
         else:
             depth_value= None
 
+        'non_blocking copies, the src images come from pinned DataLoader memory, see RayBatchPrefetcher'
         ret = {
-            "ray_o": rays_o.cuda(),
-            "ray_d": rays_d.cuda(),
-            "camera": self.camera.cuda(),
-            "depth_range": self.depth_range.cuda(),
-            "rgb": rgb.cuda() if rgb is not None else None,
-            "src_rgbs": self.src_rgbs.cuda() if self.src_rgbs is not None else None,
-            "src_cameras": self.src_cameras.cuda() if self.src_cameras is not None else None,
+            "ray_o": rays_o.cuda(non_blocking=True),
+            "ray_d": rays_d.cuda(non_blocking=True),
+            "camera": self.camera.cuda(non_blocking=True),
+            "depth_range": self.depth_range.cuda(non_blocking=True),
+            "rgb": rgb.cuda(non_blocking=True) if rgb is not None else None,
+            "src_rgbs": self.src_rgbs.cuda(non_blocking=True) if self.src_rgbs is not None else None,
+            "src_cameras": self.src_cameras.cuda(non_blocking=True) if self.src_cameras is not None else None,
+            "src_depth_values": (
+                self.src_depth_values.cuda(non_blocking=True) if self.src_depth_values is not None else None
+            ),
             "selected_inds": select_inds,
-            "sky_mask": sky_mask.cuda(),
-            "depth_value": depth_value.cuda(),
-            "idx": self.idx.cuda() if self.idx is not None else None,
+            "sample_weights": sample_weights,
+            "num_nerf_rays": num_nerf_rays,
+            "patch_shape": patch_shape,
+            "sky_mask": sky_mask.cuda(non_blocking=True),
+            "depth_value": depth_value.cuda(non_blocking=True),
+            "idx": self.idx.cuda(non_blocking=True) if self.idx is not None else None,
         }
         return ret
 
 
+    @staticmethod
+    def gather_pixels(values, select_inds):
+        'index the per-pixel values with select_inds, on the device of select_inds if it is a tensor'
+        if torch.is_tensor(select_inds):
+            values = values.to(select_inds.device, non_blocking=True)
+        return values[select_inds]
+
     'get the sky image with the rgb and sky_mask'
     def get_sky_image(self, rgb, sky_mask):
         '''
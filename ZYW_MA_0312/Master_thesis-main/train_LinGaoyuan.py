@@ -475,7 +475,7 @@ def train(args):
                         val_data, device, render_stride=args.render_stride
                     )
                     H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
-                    gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
+                    gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3).cpu()
 
                     'LinGaoyuan_operation_20240830: set create depth image by default even N_inportance is 0 in order to create depth image'
                     'LinGaoyuan_operation_20240920: set data_mode to val when use val dataset in val process'
@@ -505,7 +505,7 @@ def train(args):
                         train_data, device, render_stride=1
                     )
                     H, W = tmp_ray_train_sampler.H, tmp_ray_train_sampler.W
-                    gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3)
+                    gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3).cpu()
 
                     # filename_gt = os.path.join(out_folder, 'img_gt.png')
                     # torchvision.io.write_png(torch.tensor(gt_img * 255).to(torch.uint8).permute(2, 0, 1), filename_gt)
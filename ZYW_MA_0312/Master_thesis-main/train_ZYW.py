@@ -1,5 +1,6 @@
 import os
 import time
+import functools
 import numpy as np
 import shutil
 import torch
@@ -8,10 +9,12 @@ import torch.utils.data.distributed
 from torch.utils.data import DataLoader
 
 from model_and_model_component.data_loaders import dataset_dict
-from ZYW_model.render_ray_ZYW import render_rays
+from ZYW_model.render_ray_ZYW import render_rays, contract_pts
 from ZYW_model.render_image_ZYW import render_single_image
 from ZYW_model.model_ZYW import Model
-from model_and_model_component.sample_ray_LinGaoyuan import RaySamplerSingleImage
+from ZYW_model.occupancy_grid_ZYW import seed_occupancy_grid_from_depth_priors
+from model_and_model_component.sample_ray_LinGaoyuan import RaySamplerSingleImage, PixelErrorMap
+from model_and_model_component.ray_batch_prefetcher import RayBatchPrefetcher
 from ZYW_model.criterion_ZYW import Criterion
 from utils import img2mse, mse2psnr, img_HWC2CHW, colorize, cycle, img2psnr
 import config
@@ -29,7 +32,9 @@ import cv2
 from LinGaoyuan_function.sky_network import SKYMLP, StyleMLP, SkyModel
 from LinGaoyuan_function.sky_transformer_network import SkyTransformer, SkyTransformerModel
 from LinGaoyuan_function.update_prior_depth_value import update_prior_depth_value
-from LinGaoyuan_function.image_resize import resize_img
+from LinGaoyuan_function.image_resize import resize_img, resize_img_batched
+from LinGaoyuan_function.prior_depth_store import load_prior_depth_values, PriorDepthStore
+from LinGaoyuan_function.mip360_prop_loss import lossfun_outer_torch
 
 from utils import img2mse
 import json
@@ -57,6 +62,16 @@ def synchronize():
     dist.barrier()
 
 
+def resize_prior_depth_value(depth_value, image_resizer, args):
+    '''
+    resize the prior depth value with the same interpolation as the depth value of the ray batch: on the GPU if the dataset
+    leaves the resize to RaySamplerSingleImage (args.uint8_images or args.gpu_resize), with torchvision otherwise
+    '''
+    if args.uint8_images is True or args.gpu_resize is True:
+        return resize_img_batched(depth_value.cuda()[None, ...], args.image_resize_H, args.image_resize_W)[0]
+    return resize_img(depth_value, image_resizer)
+
+
 def train(args):
 
 
@@ -95,10 +110,34 @@ def train(args):
     'LinGaoyuan_operation_20240905: create a tensor array that save the prior depth value of all training image'
     if args.resize_image is True:
         image_resizer = torchvision.transforms.Resize((args.image_resize_H, args.image_resize_W))# Zhenyi Wan [2025/4/10] Resize a fig into[args.image_resize_H, args.image_resize_W]
-        train_prior_depth_values = torch.zeros((len(train_loader), args.image_resize_H, args.image_resize_W)).cuda()# Zhenyi Wan [2025/4/10] create a tensor to store prior values
-        #[len(train_loader), args.image_resize_H, args.image_resize_W]
+        prior_depth_shape = (args.image_resize_H, args.image_resize_W)
+        prior_depth_resize_fn = lambda depth_value: resize_prior_depth_value(depth_value, image_resizer, args)
     else:
-        train_prior_depth_values = torch.zeros((len(train_loader), args.image_H, args.image_W)).cuda()# Zhenyi Wan [2025/4/10] [len(train_loader), args.image_H, args.image_W]
+        prior_depth_shape = (args.image_H, args.image_W)
+        prior_depth_resize_fn = None
+
+    '''
+    the prior depth values are loaded in parallel and written to a consolidated cache in out_folder, the cache is reused
+    on the next launch as long as the depth value files and their mtimes are unchanged, see load_prior_depth_values()
+    '''
+    prior_depth_cache_extra = (args.use_binary_prior_cache, args.resize_image, args.uint8_images or args.gpu_resize)
+
+    def prior_depth_cache_file(name):
+        return None if args.no_prior_depth_cache is True else os.path.join(out_folder, name)
+
+    '''
+    the prior depth values are kept in a PriorDepthStore, with args.prior_depth_store = pinned / mmap they stay in host
+    memory / on disk and only the image of the current ray batch is paged to the GPU
+    '''
+    def create_prior_depth_store(prior_depth_values, name):
+        return PriorDepthStore.from_tensor(
+            prior_depth_values,
+            backend=args.prior_depth_store,
+            half=args.prior_depth_half,
+            mmap_file=os.path.join(out_folder, name + ".mmap"),
+        )
+
+    prior_depth_load_device = "cuda" if args.prior_depth_store == "cuda" else "cpu"
 
     '''
     LinGaoyuan_operation_20240920: if exit a saved train_prior_depth_values.pt file in actual out_folder, load it as train_prior_depth_values
@@ -106,18 +145,20 @@ def train(args):
     '''
     if os.path.exists(os.path.join(out_folder, "train_prior_depth_values.pt")) is True and args.save_prior_depth is True:
         print('laad exist train_prior_depth_values from {}'.format(os.path.join(out_folder, "train_prior_depth_values.pt")))
-        train_prior_depth_values = torch.load(os.path.join(out_folder, "train_prior_depth_values.pt"))
+        train_prior_depth_values = torch.load(os.path.join(out_folder, "train_prior_depth_values.pt"), map_location=prior_depth_load_device)
     else:# Zhenyi Wan [2025/4/10] if donot have a prior depth value
         print('create initial train_prior_depth_values')
-        for idx in range(len(train_dataset.depth_value_files)):
-            with open(train_dataset.depth_value_files[idx], 'r') as f:
-                depth_value_dictionary = json.load(f)# Zhenyi Wan [2025/4/10] save the depth value in a dictionary
-            train_depth_value = torch.tensor(depth_value_dictionary['depth_value_pred'])[None, ...]# Zhenyi Wan [2025/4/10] turn the depth value into pytorch tensor.[1,N]
-
-            if args.resize_image is True:
-                train_depth_value = resize_img(train_depth_value, image_resizer)
-
-            train_prior_depth_values[idx, ...] = train_depth_value
+        train_prior_depth_values = load_prior_depth_values(
+            train_dataset.depth_value_files,
+            prior_depth_shape,
+            resize_fn=prior_depth_resize_fn,
+            use_binary_cache=args.use_binary_prior_cache,
+            num_workers=args.prior_depth_load_workers,
+            cache_file=prior_depth_cache_file("train_prior_depth_values_cache.pt"),
+            cache_extra=prior_depth_cache_extra,
+            device=prior_depth_load_device,
+        )# Zhenyi Wan [2025/4/10] [len(train_loader), H, W]
+    train_prior_depth_values = create_prior_depth_store(train_prior_depth_values, "train_prior_depth_values")
 
 
 
@@ -128,20 +169,17 @@ def train(args):
     val_loader_iterator = iter(cycle(val_loader))
 
     'LinGaoyuan_operation_20240905: create a tensor array that save the prior depth value of all val image'
-    if args.resize_image is True:
-        val_prior_depth_values = torch.zeros((len(val_loader), args.image_resize_H, args.image_resize_W)).cuda()
-    else:
-        val_prior_depth_values = torch.zeros((len(val_loader), args.image_H, args.image_W)).cuda()
-
-    for idx in range(len(val_dataset.depth_value_files)):
-        with open(val_dataset.depth_value_files[idx], 'r') as f:
-            depth_value_dictionary = json.load(f)
-        val_depth_value = torch.tensor(depth_value_dictionary['depth_value_pred'])[None, ...]
-
-        if args.resize_image is True:
-            val_depth_value = resize_img(val_depth_value, image_resizer)
-
-        val_prior_depth_values[idx, ...] = val_depth_value
+    val_prior_depth_values = load_prior_depth_values(
+        val_dataset.depth_value_files,
+        prior_depth_shape,
+        resize_fn=prior_depth_resize_fn,
+        use_binary_cache=args.use_binary_prior_cache,
+        num_workers=args.prior_depth_load_workers,
+        cache_file=prior_depth_cache_file("val_prior_depth_values_cache.pt"),
+        cache_extra=prior_depth_cache_extra,
+        device=prior_depth_load_device,
+    )
+    val_prior_depth_values = create_prior_depth_store(val_prior_depth_values, "val_prior_depth_values")
 
 
     # Create GNT model
@@ -162,7 +200,14 @@ def train(args):
 
 
     # create projector
-    projector = Projector(device=device)
+    projector = Projector(
+        device=device,
+        fused_sampling=args.fused_projection_sampling,
+        texture_dtype=args.projection_texture_dtype,
+        top_k_views=args.top_k_views,
+        occlusion_test=args.occlusion_test,
+        occlusion_tolerance=args.occlusion_tolerance,
+    )
 
     # Create criterion
     criterion = Criterion()
@@ -214,6 +259,83 @@ def train(args):
         print('create initial sky style code')
         z = torch.randn(batch_size, style_dims, dtype=torch.float32, device=device)
 
+    '''
+    sample_mode importance draws the rays in proportion to a low resolution error map of every training image, the map is
+    updated with the per-ray mse of every step
+    '''
+    if args.sample_mode == "importance":
+        error_map = PixelErrorMap(
+            len(train_dataset), prior_depth_shape[0], prior_depth_shape[1],
+            cell_size=args.importance_cell_size,
+            uniform_floor=args.importance_uniform_floor,
+            momentum=args.importance_momentum,
+            device=device,
+        )
+    else:
+        error_map = None
+
+    '''
+    with args.use_occupancy_grid the samples in free space are dropped before projector.compute(). the grid over the
+    contracted space belongs to the model and is restored from its checkpoint. a new grid is seeded with the depth priors
+    of the training images. it is updated with the predicted weights every args.occupancy_update_interval steps
+    '''
+    if args.use_occupancy_grid is True:
+        occupancy_grid = model.occupancy_grid
+        if model.occupancy_grid_restored is True:
+            print("occupancy grid restored from the checkpoint, occupied: {:.4f}".format(occupancy_grid.occupancy_ratio()))
+        else:
+            seed_occupancy_grid_from_depth_priors(
+                occupancy_grid,
+                lambda pts: contract_pts(pts, args.contraction_type),
+                train_dataset.render_poses,
+                train_dataset.render_intrinsics,
+                train_prior_depth_values,
+                args.image_H,
+                args.image_W,
+                depth_range=(1.0, 200.0),  # near_depth / far_depth of NusceneDataset_train_val
+                margin=args.occupancy_seed_margin,
+            )
+            print(
+                "occupancy grid seeded from the depth priors, occupied: {:.4f}".format(occupancy_grid.occupancy_ratio())
+            )
+    else:
+        occupancy_grid = None
+
+    def prepare_ray_batch(train_data, np_rng=None, generator=None):
+        ray_sampler = RaySamplerSingleImage(train_data, device)
+        N_rand = int(
+            1.0 * args.N_rand * args.num_source_views / train_data["src_rgbs"][0].shape[0]
+        )# Zhenyi Wan [2025/4/10] Dynamically adjusts the number of rays sampled according to the number of source images and the number of pixels per image
+        ray_batch = ray_sampler.random_sample(
+            N_rand,
+            sample_mode=args.sample_mode,
+            center_ratio=args.center_ratio,
+            on_device=args.gpu_pixel_sampling,
+            error_map=error_map,
+            sky_ray_fraction=args.sky_ray_fraction,
+            patch_size=args.patch_size,
+            patch_dilation=args.patch_dilation,
+            np_rng=np_rng,
+            generator=generator,
+        )# Zhenyi Wan [2025/4/10] Randomly sample rays
+        return ray_sampler, ray_batch
+
+    '''
+    the prefetch thread draws its pixels with its own generators, it would race with the main thread on the global ones.
+    the error map of sample_mode importance is written by the training step, it can not be sampled on the side thread
+    '''
+    if args.prefetch_ray_batch is True:
+        if args.sample_mode == "importance":
+            raise Exception("sample_mode importance is not supported with prefetch_ray_batch!")
+        prefetch_seed = 234 + args.local_rank
+        prepare_ray_batch_prefetch = functools.partial(
+            prepare_ray_batch,
+            np_rng=np.random.default_rng(prefetch_seed),
+            generator=torch.Generator(device=device if args.gpu_pixel_sampling is True else "cpu").manual_seed(
+                prefetch_seed
+            ),
+        )
+
     # while global_step < model.start_step + args.n_iters + 1:
     for epoch in range(args.max_epochs):
         np.random.seed()
@@ -225,7 +347,18 @@ def train(args):
 
         epoch_step = 0
 
-        for train_data in train_loader:
+        '''
+        with args.prefetch_ray_batch the ray batches of the next steps are built on a side thread / CUDA stream by
+        RayBatchPrefetcher, otherwise they are built at the beginning of every step
+        '''
+        if args.prefetch_ray_batch is True:
+            train_batches = RayBatchPrefetcher(
+                train_loader, prepare_ray_batch_prefetch, device, args.num_prefetch_ray_batch
+            )
+        else:
+            train_batches = ((train_data, None, None) for train_data in train_loader)
+
+        for train_data, ray_sampler, ray_batch in train_batches:
 
             time0 = time.time()
 
@@ -236,15 +369,8 @@ def train(args):
 
             'render_stride is not used during training'
             # load training rays
-            ray_sampler = RaySamplerSingleImage(train_data, device)
-            N_rand = int(
-                1.0 * args.N_rand * args.num_source_views / train_data["src_rgbs"][0].shape[0]
-            )# Zhenyi Wan [2025/4/10] Dynamically adjusts the number of rays sampled according to the number of source images and the number of pixels per image
-            ray_batch = ray_sampler.random_sample(
-                N_rand,
-                sample_mode=args.sample_mode,
-                center_ratio=args.center_ratio,
-            )# Zhenyi Wan [2025/4/10] Randomly sample rays
+            if ray_batch is None:
+                ray_sampler, ray_batch = prepare_ray_batch(train_data)
 
             # Zhenyi Wan [2025/4/10] Extract featmaps from scr_rgbs. Use either ReTR method or GNT method
             if args.use_retr_feature_extractor is False:# Zhenyi Wan [2025/4/10] from GNT: ResUNET
@@ -270,7 +396,7 @@ def train(args):
             # if epoch >= args.update_prior_depth_epochs:
             if load_epoch >= args.update_prior_depth_epochs:
                 use_updated_prior_depth = True
-                train_depth_prior = (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1)
+                train_depth_prior = train_prior_depth_values.get_image(ray_batch["idx"]).reshape(-1, 1)
             else:
                 use_updated_prior_depth = False
                 train_depth_prior = None
@@ -299,6 +425,8 @@ def train(args):
                 use_updated_prior_depth=use_updated_prior_depth,
                 train_depth_prior=train_depth_prior,
                 feature_volume=feature_volume,
+                occupancy_grid=occupancy_grid,
+                occupancy_full_range=global_step % args.occupancy_explore_interval == 0,
             )
 
 
@@ -322,6 +450,12 @@ def train(args):
 
             loss, scalars_to_log = criterion(ret["outputs_coarse"], ray_batch, scalars_to_log)
 
+            if error_map is not None:
+                error_map.update(
+                    ray_batch["idx"], ray_batch["selected_inds"],
+                    criterion.per_ray_mse(ret["outputs_coarse"], ray_batch).detach(),
+                )
+
             loss_NeRO = None
             loss_NeILF = None
             if args.use_NeROPBR is True:
@@ -355,19 +489,59 @@ def train(args):
                 )
                 loss += fine_loss
 
+            '''
+            proposal loss of mip-NeRF 360: the proposal weights should be an upper envelope of the detached nerf weights.
+            the zero padded sky-only rays of sample_mode sky_stratified are left out of the mean
+            '''
+            if ret.get("outputs_proposal") is not None:
+                outputs_proposal = ret["outputs_proposal"]
+                if ray_batch.get("num_nerf_rays") is not None:
+                    outputs_proposal = {k: v[:ray_batch["num_nerf_rays"]] for k, v in outputs_proposal.items()}
+                loss_proposal = lossfun_outer_torch(
+                    outputs_proposal["t"], outputs_proposal["w"], outputs_proposal["t_env"], outputs_proposal["w_env"]
+                ).sum(dim=-1).mean()
+                loss = loss + args.lambda_proposal * loss_proposal
+                scalars_to_log["loss_proposal"] = loss_proposal.item()
+
             'LinGaoyuan_operation_20240905: update prior depth with depth prediction if epoch reach preset value'
             'LinGaoyuan_operation_20240920: add a indicator(args.update_prior_depth) to determine whether update depth prior or not'
             if use_updated_prior_depth and args.update_prior_depth is True:
                 train_depth_pred = ret["outputs_coarse"]["depth"].detach() # Zhenyi Wan [2025/4/16] (N_rand,)
-                # Zhenyi Wan [2025/4/16] write back the depth map for prior depth
-                train_depth_prior[ray_batch["selected_inds"]] = train_depth_pred[...,None]
-                if args.resize_image is True:
-                    train_depth_prior = train_depth_prior.reshape(1, args.image_resize_H, args.image_resize_W)
-                else:
-                    train_depth_prior = train_depth_prior.reshape(1,args.image_H, args.image_W)
-                train_prior_depth_values[ray_batch["idx"], ...] = train_depth_prior
+                '''
+                only the N_rand sampled pixels of the prior are updated in place. the prediction is blended into the prior
+                with args.prior_depth_momentum (1 overwrites the prior) and, with args.prior_depth_confidence, weighted per
+                ray by exp(-depth_std / preset_depth_cov)
+                '''
+                prior_depth_blend = None
+                if args.prior_depth_momentum < 1.0 or args.prior_depth_confidence is True:
+                    prior_depth_blend = args.prior_depth_momentum
+                    if args.prior_depth_confidence is True:
+                        prior_depth_blend = prior_depth_blend * torch.exp(
+                            -ret["outputs_coarse"]["depth_std"].detach() / args.preset_depth_cov
+                        )
+                'only the nerf rays of the sky_stratified sample mode have a depth prediction'
+                prior_depth_inds = ray_batch["selected_inds"]
+                if ray_batch.get("num_nerf_rays") is not None:
+                    num_nerf_rays = ray_batch["num_nerf_rays"]
+                    prior_depth_inds = prior_depth_inds[:num_nerf_rays]
+                    train_depth_pred = train_depth_pred[:num_nerf_rays]
+                    if torch.is_tensor(prior_depth_blend):
+                        prior_depth_blend = prior_depth_blend[:num_nerf_rays]
+                train_prior_depth_values.scatter_update(
+                    ray_batch["idx"], prior_depth_inds, train_depth_pred, blend=prior_depth_blend
+                )
                 # print('finish update train prior depth value in epoch: {}'.format(epoch), 'step: {}'.format(global_step))
 
+            if ret.get("outputs_occupancy") is not None:
+                occupancy_pts = ret["outputs_occupancy"]["pts"]
+                occupancy_weights = ret["outputs_occupancy"]["weights"]
+                if ray_batch.get("num_nerf_rays") is not None:
+                    occupancy_pts = occupancy_pts[:ray_batch["num_nerf_rays"]]
+                    occupancy_weights = occupancy_weights[:ray_batch["num_nerf_rays"]]
+                occupancy_grid.accumulate(occupancy_pts, occupancy_weights)
+                if global_step % args.occupancy_update_interval == 0:
+                    occupancy_grid.update()
+
             #loss.backward()
             total_loss = loss
             if loss_NeRO is not None:# Zhenyi Wan [2025/4/16] Add the PBR loss to total loss for backward
@@ -417,7 +591,9 @@ def train(args):
             if args.local_rank == 0:
                 if global_step % args.i_print == 0 or global_step < 10:
                     # write mse and psnr stats
-                    mse_error = img2mse(ret["outputs_coarse"]["rgb"], ray_batch["rgb"]).item()
+                    mse_error = img2mse(
+                        ret["outputs_coarse"]["rgb"], ray_batch["rgb"], ret["outputs_coarse"].get("mask")
+                    ).item()
                     scalars_to_log["train/coarse-loss"] = mse_error
                     scalars_to_log["train/coarse-psnr-training-batch"] = mse2psnr(mse_error)
 
@@ -453,6 +629,12 @@ def train(args):
 
                     print("each iter time {:.05f} seconds".format(dt))
 
+                    if occupancy_grid is not None:
+                        print("occupancy grid occupied: {:.4f}".format(occupancy_grid.occupancy_ratio()))
+
+                    if getattr(train_dataset, "image_cache", None) is not None:
+                        print("image cache: {}".format(train_dataset.image_cache.stats()))
+
                 if global_step % args.i_weights == 0: # Zhenyi Wan [2025/4/16] every i_weights step save the model
                     print("Saving checkpoints at {} to {}...".format(global_step, out_folder))
                     fpath = os.path.join(out_folder, "model_{:06d}.pth".format(global_step))
@@ -466,7 +648,7 @@ def train(args):
                     if args.save_prior_depth is True:
                         print("Saving train_prior_depth_values at {} to {}...".format(global_step, out_folder))
                         fpath = os.path.join(out_folder, "train_prior_depth_values.pt")
-                        torch.save(train_prior_depth_values, fpath)
+                        train_prior_depth_values.save(fpath)
 
 
 
@@ -521,7 +703,7 @@ def train(args):
                         val_data, device, render_stride=args.render_stride
                     )
                     H, W = tmp_ray_sampler.H, tmp_ray_sampler.W
-                    gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3)
+                    gt_img = tmp_ray_sampler.rgb.reshape(H, W, 3).cpu()
 
                     'LinGaoyuan_operation_20240830: set create depth image by default even N_importance is 0 in order to create depth image'
                     'LinGaoyuan_operation_20240920: set data_mode to val when use val dataset in val process'
@@ -543,6 +725,7 @@ def train(args):
                         sky_model=sky_model,
                         use_updated_prior_depth=use_updated_prior_depth,
                         data_mode='val',
+                        occupancy_grid=occupancy_grid,
                     )
                     torch.cuda.empty_cache()
 
@@ -551,7 +734,7 @@ def train(args):
                         train_data, device, render_stride=1
                     )
                     H, W = tmp_ray_train_sampler.H, tmp_ray_train_sampler.W
-                    gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3)
+                    gt_img = tmp_ray_train_sampler.rgb.reshape(H, W, 3).cpu()
 
                     # filename_gt = os.path.join(out_folder, 'img_gt.png')
                     # torchvision.io.write_png(torch.tensor(gt_img * 255).to(torch.uint8).permute(2, 0, 1), filename_gt)
@@ -580,6 +763,7 @@ def train(args):
                         data_mode='train',
                         train_prior_depth_values=train_prior_depth_values,
                         use_updated_prior_depth=use_updated_prior_depth,
+                        occupancy_grid=occupancy_grid,
                     )
             global_step += 1
 
@@ -587,6 +771,9 @@ def train(args):
 
             if global_step > model.start_step + args.n_iters + 1:
                 break
+
+        if args.prefetch_ray_batch is True:
+            train_batches.close()
         # epoch += 1
 
 
@@ -609,6 +796,7 @@ def log_view(
     data_mode=None,
     train_prior_depth_values=None,
     use_updated_prior_depth=False,
+    occupancy_grid=None,
 ):
     model.switch_to_eval() # Zhenyi Wan [2025/4/17] switch to validation mode
     with torch.no_grad():
@@ -625,7 +813,7 @@ def log_view(
         '''
         if data_mode == 'train' and use_updated_prior_depth is True:
             print('use updated prior depth for training dataset in val process')
-            train_depth_prior = (train_prior_depth_values[ray_batch["idx"], ...]).reshape(-1, 1) # Zhenyi Wan [2025/4/17] [N_rays,1]
+            train_depth_prior = train_prior_depth_values.get_image(ray_batch["idx"]).reshape(-1, 1) # Zhenyi Wan [2025/4/17] [N_rays,1]
         else:
             train_depth_prior = None
 
@@ -661,6 +849,7 @@ def log_view(
             use_updated_prior_depth=use_updated_prior_depth,
             train_depth_prior=train_depth_prior,
             data_mode=data_mode,
+            occupancy_grid=occupancy_grid,
         )
 
     color_NeRO = None